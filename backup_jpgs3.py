@@ -1,8 +1,4 @@
 try:
-    import PIL
-    import PIL.Image as PILimage
-    from PIL import ImageDraw, ImageFont, ImageEnhance
-    from PIL.ExifTags import TAGS, GPSTAGS
     import sys
     import os
     import shutil
@@ -11,9 +7,20 @@ try:
     import datetime
     import shutil
     import hashlib
-    import pyodbc
 except ImportError as err:
     exit(err)
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+try:
+    import PIL
+    import PIL.Image as PILimage
+    from PIL import ImageDraw, ImageFont, ImageEnhance
+    from PIL.ExifTags import TAGS, GPSTAGS
+except ImportError:
+    PIL = PILimage = None
+    TAGS = GPSTAGS = {}
 
 
 class ImageData(object):
@@ -480,10 +487,6 @@ def backup_photos(fromroot, destroot, filterfn = ok_to_process):
     copy_indexed_pics_to_backup(idx, destroot)
 
 try:
-    import PIL
-    import PIL.Image as PILimage
-    from PIL import ImageDraw, ImageFont, ImageEnhance
-    from PIL.ExifTags import TAGS, GPSTAGS
     import sys
     import os
     import shutil
@@ -492,26 +495,872 @@ try:
     import datetime
     import shutil
     import hashlib
-    import pyodbc
+    import time
+    import sqlite3
+    import io
+    import struct
+    import array
+    import collections
+    import concurrent.futures
+    import queue
+    import threading
+    import json
+    import random
+    import platform
+    import functools
 except ImportError as err:
     exit(err)
+try:
+    import pyodbc   # only needed for a CatalogSink on an ODBC database
+except ImportError:
+    pyodbc = None
+try:
+    import fcntl    # only used for reflink copies, not available on Windows
+except ImportError:
+    fcntl = None
+try:
+    import PIL
+    import PIL.Image as PILimage
+    from PIL import ImageDraw, ImageFont, ImageEnhance
+    from PIL.ExifTags import TAGS, GPSTAGS
+except ImportError:
+    # PIL is optional; ExifParser handles date bucketing on its own, and
+    # PIL is only the fallback for EXIF data it can't make sense of
+    PIL = PILimage = None
+    TAGS = GPSTAGS = {}
+
+
+####################   Hashers   ##############################
+# Digest algorithms available for hashing photos. SHA-256 digests are stored
+# as bare hex, as they always have been; digests from any other algorithm are
+# tagged "algo:hex", so a catalog holding a mix of them stays unambiguous.
+HASHERS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+try:
+    import blake3
+    HASHERS['blake3'] = blake3.blake3
+except ImportError:
+    pass
+try:
+    import xxhash
+    HASHERS['xxh3'] = xxhash.xxh3_128
+except ImportError:
+    pass
+DEFAULT_HASH = 'sha256'
+
+
+def new_hasher(algo):
+    if (algo not in HASHERS):
+        raise ValueError("Unknown hash algorithm '{0}' (available: {1})".format(algo, ", ".join(sorted(HASHERS))))
+    return HASHERS[algo]()
+
+
+def tag_digest(algo, hexdigest):
+    # stored form of a digest: bare hex for sha256, "algo:hex" otherwise
+    if (algo == 'sha256'):
+        return hexdigest
+    return "{0}:{1}".format(algo, hexdigest)
+
+
+def digest_algo(digest):
+    # algorithm that produced a stored (possibly tagged) digest
+    if (digest is None):
+        return None
+    (algo, sep, hexdigest) = digest.partition(':')
+    return algo if sep else 'sha256'
+
+
+def benchmark_hashers(nbytes = 64 * 1024 * 1024, bufsize = 262144):
+    '''
+        Measure the in-memory throughput of every available hash algorithm
+        :param: nbytes (amount of data to hash with each algorithm)
+        :return: dictionary[algo] = MB/s
+    '''
+    buf = os.urandom(bufsize)
+    results = {}
+    for algo in sorted(HASHERS):
+        hash = new_hasher(algo)
+        start = time.perf_counter()
+        for i in range(max(1, nbytes // bufsize)):
+            hash.update(buf)
+        hash.hexdigest()
+        elapsed = time.perf_counter() - start
+        results[algo] = (nbytes / (1024 * 1024)) / max(elapsed, 1e-9)
+        print("{0:>8}: {1:8.1f} MB/s".format(algo, results[algo]))
+    return results
+
+
+def fastest_hasher(nbytes = 64 * 1024 * 1024):
+    # name of the algorithm with the best throughput on this machine
+    results = benchmark_hashers(nbytes)
+    return max(results, key=results.get)
+
+
+def archive_algo(stored, algo=None, rehash=False):
+    '''
+        Pick the hash algorithm an archive is to use
+        :param: stored (algorithm the archive was made with, None for a new archive)
+        :param: algo (algorithm asked for, None for whatever the archive uses)
+        :param: rehash (switch an existing archive to algo, rehashing its files)
+        :return: name of the algorithm
+    '''
+    if (algo is None or stored is None or algo == stored or rehash):
+        return algo or stored or DEFAULT_HASH
+    print("Archive is hashed with {0}, not {1}: keeping {0} (pass rehash=True to switch)".format(stored, algo))
+    return stored
+
+
+####################   File copying   #########################
+FICLONE = 0x40049409    # Linux ioctl: make dst share src's extents (btrfs, XFS, ...)
+COPY_BUFSIZE = 1024 * 1024
+
+
+def copy_file_fast(src, dst, bufsize = COPY_BUFSIZE):
+    '''
+        Copy src to dst using the cheapest mechanism the platform and filesystem
+        allow: a reflink clone (FICLONE), then os.copy_file_range, then
+        os.sendfile, then plain reads and writes with a large buffer. Each
+        in-kernel method is abandoned for the next if it isn't supported here.
+        Timestamps and mode bits are preserved as with shutil.copy2.
+        :return: name of the strategy that did the copy
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        strategy = None
+        for (name, copyfn) in _COPY_STRATEGIES:
+            if (copyfn is None):
+                continue
+            try:
+                copyfn(fsrc.fileno(), fdst.fileno(), size)
+                if (os.fstat(fdst.fileno()).st_size != size):
+                    raise OSError("{0} copied {1} of {2} bytes".format(name, os.fstat(fdst.fileno()).st_size, size))
+                strategy = name
+                break
+            except OSError:
+                # not supported between these files; start over with the next method
+                fdst.truncate(0)
+                os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+        if (strategy is None):
+            while True:
+                data = fsrc.read(bufsize)
+                if not data:
+                    break
+                fdst.write(data)
+            strategy = "buffered"
+    shutil.copystat(src, dst)
+    return strategy
+
+
+def _copy_reflink(fdin, fdout, size):
+    fcntl.ioctl(fdout, FICLONE, fdin)
+
+
+def _copy_range(fdin, fdout, size):
+    copied = 0
+    while (copied < size):
+        n = os.copy_file_range(fdin, fdout, size - copied)
+        if (n == 0):
+            break
+        copied += n
+    if (copied != size):
+        # e.g. nothing at all from filesystems that don't really support it
+        raise OSError("copy_file_range stopped after {0} of {1} bytes".format(copied, size))
+
+
+def _copy_sendfile(fdin, fdout, size):
+    copied = 0
+    while (copied < size):
+        n = os.sendfile(fdout, fdin, copied, size - copied)
+        if (n == 0):
+            break
+        copied += n
+    if (copied != size):
+        raise OSError("sendfile stopped after {0} of {1} bytes".format(copied, size))
+
+
+def copy_file_hashed(src, dst, algo = DEFAULT_HASH, bufsize = COPY_BUFSIZE):
+    '''
+        Copy src to dst through a userspace buffer, hashing the data as it is
+        written, so the copy can be verified without reading either file again.
+        Timestamps and mode bits are preserved as with shutil.copy2.
+        :return: stored (tagged) digest of the data written
+    '''
+    hash = new_hasher(algo)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            data = fsrc.read(bufsize)
+            if not data:
+                break
+            hash.update(data)
+            fdst.write(data)
+    shutil.copystat(src, dst)
+    return tag_digest(algo, hash.hexdigest())
+
+
+_COPY_STRATEGIES = [
+    ("reflink", _copy_reflink if fcntl is not None else None),
+    ("copy_file_range", _copy_range if hasattr(os, "copy_file_range") else None),
+    ("sendfile", _copy_sendfile if hasattr(os, "sendfile") else None),
+]
+
+
+####################   RunStats   #############################
+class RunStats(object):
+    '''
+        Instrumentation for a backup run. For each pipeline stage it records
+        the number of files, bytes, wall and CPU (thread) time, and keeps a
+        random sample of per-file latencies for percentiles; it also keeps
+        plain event counters (copied, dupes, ...). Stages can nest: "walk"
+        includes the stat calls the scandir walk makes, and "dedup" includes
+        any "hydrate" it triggers. Safe to share between threads. Stages run
+        in a process pool (PhotoIndexer pool="process") aren't recorded.
+    '''
+    STAGES = ("walk", "stat", "exif", "hash", "dedup", "phash", "hydrate", "copy")
+    SAMPLES = 4096      # latencies kept per stage for the percentiles
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.wall0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.stages = dict()    # stage -> [count, bytes, wall, cpu, samples]
+        self.counters = collections.Counter()
+        self.random = random.Random(0)
+    
+    def record(self, stage, wall, cpu, nbytes=0):
+        # one file's worth of work in stage
+        with self.lock:
+            entry = self.stages.get(stage)
+            if (entry is None):
+                entry = self.stages[stage] = [0, 0, 0.0, 0.0, []]
+            entry[0] += 1
+            entry[1] += nbytes
+            entry[2] += wall
+            entry[3] += cpu
+            samples = entry[4]
+            if (len(samples) < self.SAMPLES):
+                samples.append(wall)
+            else:
+                # reservoir sampling keeps every file equally likely to be in the sample
+                i = self.random.randrange(entry[0])
+                if (i < self.SAMPLES):
+                    samples[i] = wall
+    
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+    
+    @staticmethod
+    def percentile(samples, p):
+        # nearest-rank percentile of an unsorted list
+        if (not samples):
+            return 0.0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+    
+    def report(self):
+        '''
+            :return: dictionary summarizing the run so far, as written by write_json
+        '''
+        with self.lock:
+            stages = dict()
+            order = [s for s in self.STAGES if s in self.stages] + sorted(set(self.stages) - set(self.STAGES))
+            for stage in order:
+                (count, nbytes, wall, cpu, samples) = self.stages[stage]
+                stages[stage] = {"files": count,
+                                 "bytes": nbytes,
+                                 "wall_seconds": round(wall, 6),
+                                 "cpu_seconds": round(cpu, 6),
+                                 "files_per_second": round(count / wall, 2) if wall > 0 else None,
+                                 "mb_per_second": round(nbytes / (1024 * 1024) / wall, 2) if wall > 0 else None,
+                                 "p50_ms": round(self.percentile(samples, 50) * 1000, 3),
+                                 "p95_ms": round(self.percentile(samples, 95) * 1000, 3),
+                                 "p99_ms": round(self.percentile(samples, 99) * 1000, 3)}
+            return {"host": platform.node(),
+                    "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                    "wall_seconds": round(time.perf_counter() - self.wall0, 3),
+                    "cpu_seconds": round(time.process_time() - self.cpu0, 3),
+                    "stages": stages,
+                    "counters": dict(self.counters)}
+    
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+    
+    def write_prometheus(self, filename, prefix="photo_backup"):
+        '''
+            Write the report in Prometheus text format, e.g. for node_exporter's
+            textfile collector. The file is written under a temporary name and
+            renamed, so the collector never reads half of it.
+        '''
+        report = self.report()
+        lines = []
+        def metric(name, kind, help, rows):
+            lines.append("# HELP {0}_{1} {2}".format(prefix, name, help))
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+            for (labels, value) in rows:
+                lines.append("{0}_{1}{{{2}}} {3}".format(prefix, name, labels, value))
+        stages = report["stages"]
+        metric("stage_files_total", "counter", "Files handled by each stage.",
+               [('stage="{0}"'.format(s), stages[s]["files"]) for s in stages])
+        metric("stage_bytes_total", "counter", "Bytes handled by each stage.",
+               [('stage="{0}"'.format(s), stages[s]["bytes"]) for s in stages])
+        metric("stage_wall_seconds_total", "counter", "Wall time spent in each stage.",
+               [('stage="{0}"'.format(s), stages[s]["wall_seconds"]) for s in stages])
+        metric("stage_cpu_seconds_total", "counter", "CPU time spent in each stage.",
+               [('stage="{0}"'.format(s), stages[s]["cpu_seconds"]) for s in stages])
+        metric("stage_latency_seconds", "summary", "Per-file latency of each stage.",
+               [('stage="{0}",quantile="{1}"'.format(s, q), stages[s]["p{0}_ms".format(p)] / 1000.0)
+                for s in stages for (p, q) in ((50, "0.5"), (95, "0.95"), (99, "0.99"))])
+        # a summary's _sum and _count: the stage's total latency and how many files it timed
+        for s in stages:
+            lines.append('{0}_stage_latency_seconds_sum{{stage="{1}"}} {2}'.format(prefix, s, stages[s]["wall_seconds"]))
+            lines.append('{0}_stage_latency_seconds_count{{stage="{1}"}} {2}'.format(prefix, s, stages[s]["files"]))
+        metric("events_total", "counter", "Run events (copied, dupes, errors, ...).",
+               [('event="{0}"'.format(e), n) for (e, n) in sorted(report["counters"].items())])
+        lines.append("# HELP {0}_run_seconds Wall time of the run.".format(prefix))
+        lines.append("# TYPE {0}_run_seconds gauge".format(prefix))
+        lines.append("{0}_run_seconds {1}".format(prefix, report["wall_seconds"]))
+        tempname = filename + ".tmp"
+        with open(tempname, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tempname, filename)
+    
+
+class StageTimer(object):
+    '''
+        Times one file's trip through a stage: use as "with StageTimer(stats,
+        stage) as t:", setting t.nbytes if there are bytes to count. With
+        stats of None it just runs the block. exclude(inner) takes a nested
+        timer's time back out of this one.
+    '''
+    __slots__ = ('stats', 'stage', 'nbytes', 'wall', 'cpu', 'skipwall', 'skipcpu')
+    def __init__(self, stats, stage, nbytes=0):
+        self.stats = stats
+        self.stage = stage
+        self.nbytes = nbytes
+        self.skipwall = self.skipcpu = 0.0
+    
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+    
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.thread_time() - self.cpu
+        if (self.stats is not None):
+            self.stats.record(self.stage, self.wall - self.skipwall, self.cpu - self.skipcpu, self.nbytes)
+        return False
+    
+    def exclude(self, inner):
+        self.skipwall += inner.wall
+        self.skipcpu += inner.cpu
+    
+
+####################   ExifParser   ###########################
+class ExifFormatError(Exception):
+    '''
+        Raised by ExifParser when the JPEG or its EXIF block is malformed
+    '''
+    pass
+
+
+class ExifParser(object):
+    '''
+        Minimal EXIF reader used to bucket photos without decoding them through
+        PIL. It walks the JPEG markers to the APP1 "Exif" segment and then the
+        TIFF IFDs inside it, pulling out only DateTime, DateTimeOriginal,
+        DateTimeDigitized and the GPS position. MakerNotes, thumbnails and all
+        other tags are never touched. The result is shaped like
+        ImageData.exif_data, so ImageData can use it directly. parse reads
+        everything at once; open and read_group let ImageData read each IFD
+        only when one of its fields is asked for.
+    '''
+    TAG_DATETIME = 0x0132
+    TAG_EXIF_IFD = 0x8769
+    TAG_GPS_IFD = 0x8825
+    TAG_DATETIME_ORIGINAL = 0x9003
+    TAG_DATETIME_DIGITIZED = 0x9004
+    TAG_THUMBNAIL_OFFSET = 0x0201   # in IFD1
+    TAG_THUMBNAIL_LENGTH = 0x0202
+    IFD0_TAGS = {TAG_DATETIME: 'DateTime', TAG_EXIF_IFD: None, TAG_GPS_IFD: None}
+    EXIF_TAGS = {TAG_DATETIME_ORIGINAL: 'DateTimeOriginal', TAG_DATETIME_DIGITIZED: 'DateTimeDigitized'}
+    GPS_TAGS = {1: 'GPSLatitudeRef', 2: 'GPSLatitude', 3: 'GPSLongitudeRef', 4: 'GPSLongitude'}
+    GROUPS = ("ifd0", "exif", "gps")   # for read_group
+    POINTER_TAGS = (TAG_EXIF_IFD, TAG_GPS_IFD)  # offsets of other IFDs: one LONG (or IFD) each
+    # bytes per value, by TIFF field type
+    TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 13: 4}
+    # what malformed data makes struct and _decode raise, turned into ExifFormatError
+    DECODE_ERRORS = (struct.error, TypeError, ValueError, IndexError)
+    FAILURES = (ExifFormatError,) + DECODE_ERRORS     # everything a caller should treat as unparseable
+    
+    @staticmethod
+    def parse(data):
+        '''
+            Extract the date and GPS fields from the leading bytes of a JPEG file
+            :param: data (bytes from the start of the file, at least through the APP1 segment)
+            :return: dict like ImageData.exif_data (empty if the JPEG carries no EXIF)
+            :raises: ExifFormatError if the data is not a well-formed JPEG/EXIF header
+        '''
+        block = ExifParser.open(data)
+        exif_data = {}
+        if (block is None):
+            return exif_data
+        for group in ExifParser.GROUPS:
+            exif_data.update(ExifParser.read_group(block, group))
+        return exif_data
+    
+    @staticmethod
+    def open(data):
+        '''
+            First step of parse: find the EXIF block and read IFD0, which holds
+            DateTime and the pointers to the other IFDs
+            :return: (tiff, endian, IFD0 entries), to pass to read_group, or None
+            if the JPEG carries no EXIF
+            :raises: ExifFormatError if the data is not a well-formed JPEG/EXIF header
+        '''
+        tiff = ExifParser.find_exif_segment(data)
+        if (tiff is None):
+            return None
+        try:
+            if (tiff[:4] == b'II*\x00'):
+                endian = '<'
+            elif (tiff[:4] == b'MM\x00*'):
+                endian = '>'
+            else:
+                raise ExifFormatError("bad TIFF header")
+            ifd0 = ExifParser._read_ifd(tiff, struct.unpack_from(endian + 'I', tiff, 4)[0], endian, ExifParser.IFD0_TAGS)
+        except ExifParser.DECODE_ERRORS as e:
+            raise ExifFormatError("malformed EXIF data -- {0}".format(e))
+        return (tiff, endian, ifd0)
+    
+    @staticmethod
+    def read_group(block, group):
+        '''
+            Read one group of fields from a block returned by open: "ifd0"
+            (DateTime), "exif" (DateTimeOriginal, DateTimeDigitized) or "gps" (GPSInfo)
+            :return: dict like ImageData.exif_data, with only that group's fields
+            :raises: ExifFormatError if the IFD is malformed, or its pointer is
+            not a single offset inside the block
+        '''
+        if (group not in ExifParser.GROUPS):
+            raise ValueError("Unknown EXIF group {0}".format(group))
+        (tiff, endian, ifd0) = block
+        exif_data = {}
+        try:
+            if (group == "ifd0"):
+                if (ExifParser.TAG_DATETIME in ifd0):
+                    exif_data['DateTime'] = ifd0[ExifParser.TAG_DATETIME]
+            elif (group == "exif"):
+                if (ExifParser.TAG_EXIF_IFD in ifd0):
+                    offset = ExifParser._pointer(tiff, ifd0, ExifParser.TAG_EXIF_IFD)
+                    sub = ExifParser._read_ifd(tiff, offset, endian, ExifParser.EXIF_TAGS)
+                    for tag, name in ExifParser.EXIF_TAGS.items():
+                        if (tag in sub):
+                            exif_data[name] = sub[tag]
+            elif (group == "gps"):
+                if (ExifParser.TAG_GPS_IFD in ifd0):
+                    offset = ExifParser._pointer(tiff, ifd0, ExifParser.TAG_GPS_IFD)
+                    sub = ExifParser._read_ifd(tiff, offset, endian, ExifParser.GPS_TAGS)
+                    exif_data['GPSInfo'] = dict((ExifParser.GPS_TAGS[tag], value) for tag, value in sub.items())
+        except ExifParser.DECODE_ERRORS as e:
+            raise ExifFormatError("malformed EXIF data -- {0}".format(e))
+        return exif_data
+    
+    @staticmethod
+    def _pointer(tiff, ifd0, tag):
+        # offset of the IFD that IFD0 entry tag points to, if it is a usable one
+        offset = ifd0[tag]
+        if (not isinstance(offset, int) or offset < 8 or offset + 2 > len(tiff)):
+            raise ExifFormatError("bad IFD pointer in entry {0:#06x}".format(tag))
+        return offset
+    
+    @staticmethod
+    def thumbnail(data):
+        '''
+            Return the embedded JPEG thumbnail (from IFD1) of the JPEG whose leading
+            bytes are data, or None if it has none
+            :raises: ExifFormatError if the data is not a well-formed JPEG/EXIF header
+        '''
+        tiff = ExifParser.find_exif_segment(data)
+        if (tiff is None):
+            return None
+        try:
+            if (tiff[:4] == b'II*\x00'):
+                endian = '<'
+            elif (tiff[:4] == b'MM\x00*'):
+                endian = '>'
+            else:
+                raise ExifFormatError("bad TIFF header")
+            ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+            count = struct.unpack_from(endian + 'H', tiff, ifd0)[0]
+            ifd1 = struct.unpack_from(endian + 'I', tiff, ifd0 + 2 + 12 * count)[0]
+            if (ifd1 == 0):
+                return None
+            tags = (ExifParser.TAG_THUMBNAIL_OFFSET, ExifParser.TAG_THUMBNAIL_LENGTH)
+            values = ExifParser._read_ifd(tiff, ifd1, endian, dict.fromkeys(tags))
+        except ExifParser.DECODE_ERRORS as e:
+            raise ExifFormatError("malformed EXIF data -- {0}".format(e))
+        if (tags[0] not in values or tags[1] not in values):
+            return None
+        (start, length) = (values[tags[0]], values[tags[1]])
+        if (not isinstance(start, int) or not isinstance(length, int)):
+            raise ExifFormatError("bad thumbnail offset or length")
+        if (length == 0 or start + length > len(tiff)):
+            return None
+        return tiff[start:start + length]
+    
+    @staticmethod
+    def find_exif_segment(data):
+        # return the TIFF block inside the APP1 "Exif" segment, or None if the
+        # JPEG has none ahead of its image data
+        if (data[:2] != b'\xff\xd8'):
+            raise ExifFormatError("not a JPEG file")
+        pos = 2
+        while (pos + 4 <= len(data)):
+            if (data[pos] != 0xFF):
+                raise ExifFormatError("bad JPEG marker at offset {0}".format(pos))
+            marker = data[pos + 1]
+            if (marker == 0xFF):            # fill byte
+                pos += 1
+                continue
+            if (marker in (0xD9, 0xDA)):    # EOI or SOS, no EXIF segment
+                return None
+            if (0xD0 <= marker <= 0xD7 or marker == 0x01):  # standalone markers
+                pos += 2
+                continue
+            seglen = struct.unpack_from('>H', data, pos + 2)[0]
+            if (marker == 0xE1 and data[pos + 4:pos + 10] == b'Exif\x00\x00'):
+                end = pos + 2 + seglen
+                if (end > len(data)):
+                    raise ExifFormatError("truncated APP1 segment")
+                return data[pos + 10:end]
+            pos += 2 + seglen
+        raise ExifFormatError("no EXIF segment or image data found in first {0} bytes".format(len(data)))
+    
+    @staticmethod
+    def _read_ifd(tiff, offset, endian, wanted):
+        # read the entries in wanted (a dict keyed by tag) from the IFD at offset
+        values = {}
+        count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+        pos = offset + 2
+        for i in range(count):
+            (tag, type, n) = struct.unpack_from(endian + 'HHI', tiff, pos)
+            size = ExifParser.TYPE_SIZES.get(type)
+            if (tag in ExifParser.POINTER_TAGS and tag in wanted and (type not in (4, 13) or n != 1)):
+                values[tag] = None  # not an offset; read_group rejects it if the IFD is wanted
+            elif (tag in wanted and size is not None):
+                total = size * n
+                if (total <= 4):
+                    valpos = pos + 8        # value is stored inline
+                else:
+                    valpos = struct.unpack_from(endian + 'I', tiff, pos + 8)[0]
+                if (valpos + total > len(tiff)):
+                    raise ExifFormatError("IFD entry {0:#06x} points past end of EXIF data".format(tag))
+                values[tag] = ExifParser._decode(tiff[valpos:valpos + total], type, n, endian)
+            pos += 12
+        return values
+    
+    @staticmethod
+    def _decode(raw, type, n, endian):
+        if (type == 2):     # ASCII
+            return raw.split(b'\x00', 1)[0].decode('ascii', 'replace')
+        if (type in (5, 10)):   # (signed) rationals, as (numerator, denominator) pairs
+            fmt = 'I' if type == 5 else 'i'
+            nums = struct.unpack(endian + fmt * (2 * n), raw)
+            value = tuple((nums[i], nums[i + 1]) for i in range(0, len(nums), 2))
+        else:
+            fmt = {1: 'B', 3: 'H', 4: 'I', 7: 'B', 9: 'i', 13: 'I'}[type]
+            value = struct.unpack(endian + fmt * n, raw)
+        return value[0] if n == 1 else value
+
+
+# dates that aren't zero-padded to fixed width, e.g. "2019:1:5 9:03:00"
+LOOSE_EXIF_DATE = re.compile(r"(\d{1,4})([-/:])(\d{1,2})\2(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2}):(\d{1,2}))?$")
+
+@functools.lru_cache(maxsize=1024)
+def parse_exif_date(value):
+    '''
+        Parse an EXIF date, "YYYY:MM:DD HH:MM:SS" (or with - or / between the
+        date fields), by fixed offsets rather than strptime. Trailing NULs and
+        blanks are ignored, and a missing or blanked-out time ("  :  :  ")
+        is taken as midnight. Cached, since bursts of photos (and the three
+        dates of one photo) repeat the same string.
+        :return: datetime, or None if value isn't a real date (e.g. "0000:00:00 00:00:00")
+    '''
+    if not isinstance(value, str):
+        return None
+    s = value.rstrip("\x00 ")
+    if (len(s) < 10 or s[4] not in "-/:" or s[7] != s[4]):
+        return _parse_loose_exif_date(s)
+    (year, month, day) = (s[0:4], s[5:7], s[8:10])
+    if not (year.isdigit() and month.isdigit() and day.isdigit()):
+        return _parse_loose_exif_date(s)
+    try:
+        date = datetime.datetime(int(year), int(month), int(day))
+    except ValueError:      # out of range, e.g. 0000:00:00 or 2019:02:30
+        return None
+    (hour, minute, second) = (s[11:13], s[14:16], s[17:19])
+    if (len(s) >= 19 and s[13] == ':' and s[16] == ':' and
+            hour.isdigit() and minute.isdigit() and second.isdigit()):
+        try:
+            return date.replace(hour=int(hour), minute=int(minute), second=int(second))
+        except ValueError:
+            pass    # the date is still good, which is all bucketing needs
+    return date
+
+
+def _parse_loose_exif_date(s):
+    # slow path of parse_exif_date, for dates strptime would take but the fixed offsets don't
+    match = LOOSE_EXIF_DATE.match(s)
+    if (match is None):
+        return None
+    fields = [int(f) for f in match.group(1, 3, 4, 5, 6, 7) if f is not None]
+    try:
+        return datetime.datetime(*fields)
+    except ValueError:
+        return None
 
 
+####################   Perceptual hashes   ####################
+# A dHash is 64 bits: a photo is shrunk to 9x8 greyscale and each bit says
+# whether a pixel is brighter than its right-hand neighbour. Re-exports,
+# recompressed and EXIF-stripped copies of a shot come out within a few bits
+# of each other, where their SHA-256s have nothing in common. Needs PIL.
+def dhash_image(img):
+    small = img.convert('L').resize((9, 8), PILimage.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def perceptual_hash(file, thumbnail=True, headsize=262144):
+    '''
+        dHash of an image file, from its EXIF thumbnail if it has one (and
+        thumbnail is True), otherwise from a reduced-size decode of the image
+        :return: 64-bit int, or None if PIL is missing or can't decode the file
+    '''
+    if (PILimage is None):
+        return None
+    try:
+        img = None
+        if (thumbnail):
+            with open(file, 'rb') as f:
+                head = f.read(headsize)
+            try:
+                thumb = ExifParser.thumbnail(head)
+            except ExifFormatError:
+                thumb = None
+            if (thumb is not None):
+                img = PILimage.open(io.BytesIO(thumb))
+        if (img is None):
+            img = PILimage.open(file)
+            img.draft('L', (64, 64))    # JPEGs decode at 1/2..1/8 scale, much faster
+        with img:
+            return dhash_image(img)
+    except Exception:
+        return None
+
+
+def hamming(a, b):
+    # number of bits in which a and b differ
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+    '''
+        Burkhard-Keller tree over perceptual hashes, for finding every hash
+        within a Hamming distance of another without comparing against all of
+        them. Each node keeps its children by their distance from it, and the
+        triangle inequality rules out all but a band of them at each level.
+    '''
+    def __init__(self, distance=hamming):
+        self.distance = distance
+        self.root = None    # [key, items, {distance: child}]
+        self.size = 0
+    
+    def add(self, key, item):
+        self.size += 1
+        if (self.root is None):
+            self.root = [key, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = self.distance(key, node[0])
+            if (d == 0):
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if (child is None):
+                node[2][d] = [key, [item], {}]
+                return
+            node = child
+    
+    def search(self, key, maxdist):
+        '''
+            :return: list of (distance, item) for every item whose key is within
+            maxdist of key, closest first
+        '''
+        found = []
+        stack = [self.root] if (self.root is not None) else []
+        while stack:
+            node = stack.pop()
+            d = self.distance(key, node[0])
+            if (d <= maxdist):
+                found.extend((d, item) for item in node[1])
+            for (childdist, child) in node[2].items():
+                if (d - maxdist <= childdist <= d + maxdist):
+                    stack.append(child)
+        return sorted(found)
+    
+    def __len__(self):
+        return self.size
+    
+
 ####################   ImageData   ############################
+class _LazySlot(object):
+    '''
+        Cached attribute for a class with __slots__: getter runs the first time
+        the attribute is read, and its value is kept in the slot named slot
+    '''
+    __slots__ = ("getter", "slot")
+    def __init__(self, getter, slot):
+        self.getter = getter
+        self.slot = slot
+    
+    def __get__(self, obj, cls):
+        if (obj is None):
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:      # slot not filled yet
+            value = self.getter(obj)
+            setattr(obj, self.slot, value)
+            return value
+
+
 class ImageData(object):
     '''
-        Class to extract image EXIF data
+        Class to extract image EXIF data. The fields (lat, lon, date, origdate,
+        digidate, earliest_date) are worked out the first time they are read.
+        When built by from_bytes, only the IFDs holding the fields read are
+        parsed: earliest_date needs IFD0 and the Exif IFD, lat and lon the GPS
+        IFD. exif_data, if asked for, is everything, parsed at once.
     '''
-    def __init__(self, img):
+    __slots__ = ("img", "_block", "_fields", "_exif_data", "_lat", "_lon", "_date", "_origdate", "_digidate",
+                 "_earliest_date")
+    FIELD_GROUPS = {'DateTime': "ifd0", 'DateTimeOriginal': "exif", 'DateTimeDigitized': "exif",
+                    'GPSInfo': "gps"}   # ExifParser.read_group each exif_data field comes from
+    def __init__(self, img, exif_data=None, exifblock=None):
+        '''
+            :param: img (PIL image to read the EXIF from, if neither of the others is given)
+            :param: exif_data (fields already extracted, e.g. by ExifParser.parse)
+            :param: exifblock (ExifParser.open result, to read the fields from as needed)
+        '''
         self.img = img
-        self.get_exif_data()
-        self.lat = self.get_lat()
-        self.lon = self.get_lon()
-        self.date =self.get_date_time()
-        self.origdate = self.get_orig_date_time()
-        self.digidate = self.get_digi_date_time()
-        self.earliest_date = self.get_earliest_exif_date()
-        super(ImageData, self).__init__()
+        self._block = exifblock
+        self._fields = dict()   # exif_data fields read from _block so far, by group
+        if (exif_data is not None):
+            self._exif_data = exif_data     # already extracted, e.g. by ExifParser
+        elif (exifblock is None):
+            self.get_exif_data()    # PIL reads it all at once, and the image may be closed soon
+    
+    lat = _LazySlot(lambda self: self.get_lat(), "_lat")
+    lon = _LazySlot(lambda self: self.get_lon(), "_lon")
+    date = _LazySlot(lambda self: self.get_date_time(), "_date")
+    origdate = _LazySlot(lambda self: self.get_orig_date_time(), "_origdate")
+    digidate = _LazySlot(lambda self: self.get_digi_date_time(), "_digidate")
+    earliest_date = _LazySlot(lambda self: self.get_earliest_exif_date(), "_earliest_date")
+    
+    @property
+    def exif_data(self):
+        try:
+            return self._exif_data
+        except AttributeError:
+            exif_data = dict()
+            for group in ExifParser.GROUPS:
+                exif_data.update(self._group(group))
+            self._exif_data = exif_data
+            return exif_data
+    
+    @exif_data.setter
+    def exif_data(self, value):
+        self._exif_data = value
+    
+    @property
+    def parsed(self):
+        # False if nothing could read the EXIF (exif_data is None), without parsing any more of it
+        return (self._block is not None or self.exif_data is not None)
+    
+    def _group(self, group):
+        # the exif_data fields of one ExifParser.read_group group, read from the block the first time
+        fields = self._fields.get(group)
+        if (fields is None):
+            try:
+                fields = ExifParser.read_group(self._block, group)
+            except ExifParser.FAILURES:
+                fields = dict()     # a damaged IFD just leaves its fields unknown
+            self._fields[group] = fields
+        return fields
+    
+    def _field(self, name):
+        # one exif_data field, reading only the IFD that holds it if we have a block
+        if (self._block is not None and not hasattr(self, "_exif_data")):
+            return self._group(self.FIELD_GROUPS[name]).get(name)
+        if self.exif_data and name in self.exif_data:
+            return self.exif_data[name]
+        return None
+    
+    @classmethod
+    def from_paths(cls, paths, headsize=262144, workers=0):
+        '''
+            Build an ImageData for each of a list of files, from the leading
+            headsize bytes of each (see from_bytes), workers files at a time.
+            :return: list in the same order as paths, with None for files that
+            couldn't be read
+        '''
+        def load(path):
+            try:
+                with open(path, 'rb') as f:
+                    head = f.read(headsize)
+            except OSError as e:
+                print("Error reading {0} -- {1}".format(path, e))
+                return None
+            return cls.from_bytes(head)
+        if (workers is None or workers <= 1):
+            return [load(path) for path in paths]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(load, paths))
+    
+    @classmethod
+    def from_bytes(cls, data):
+        '''
+            Build an ImageData from the leading bytes of an image file, which
+            only need to reach as far as the EXIF segment. ExifParser is tried
+            first (reading just IFD0 up front); PIL is only used (when available)
+            for data it rejects. If neither can parse it, the result has
+            exif_data of None.
+        '''
+        try:
+            block = ExifParser.open(data)
+            if (block is None):
+                return cls(None, {})    # a JPEG without EXIF
+            return cls(None, exifblock=block)
+        except ExifParser.FAILURES:
+            pass
+        img = None
+        if (PILimage is not None):
+            try:
+                img = PILimage.open(io.BytesIO(data))
+            except Exception:
+                img = None
+        return cls(img)
     
     @staticmethod
     def get_if_exist(data, key):
@@ -525,16 +1374,15 @@ class ImageData(object):
             Helper function to convert the GPS coordinates
             stored in the EXIF to degrees in float format
         """
-        d0 = value[0][0]
-        d1 = value[0][1]
-        d = float(d0) / float(d1)
-        m0 = value[1][0]
-        m1 = value[1][1]
-        m = float(m0) / float(m1)
-        
-        s0 = value[2][0]
-        s1 = value[2][1]
-        s = float(s0) / float(s1)
+        def to_float(r):
+            # (numerator, denominator) pairs from ExifParser and older PIL,
+            # IFDRational objects from newer PIL
+            if isinstance(r, tuple):
+                return float(r[0]) / float(r[1])
+            return float(r)
+        d = to_float(value[0])
+        m = to_float(value[1])
+        s = to_float(value[2])
         
         return d + (m / 60.0) + (s / 3600.0)
     
@@ -567,9 +1415,8 @@ class ImageData(object):
             Returns the latitude and longitude, if available, from the 
             provided exif_data (obtained through get_exif_data above)
         """
-        # print(exif_data)
-        if self.exif_data and 'GPSInfo' in self.exif_data:
-            gps_info = self.exif_data["GPSInfo"]
+        gps_info = self._field('GPSInfo')
+        if gps_info is not None:
             gps_latitude = self.get_if_exist(gps_info, "GPSLatitude")
             gps_latitude_ref = self.get_if_exist(gps_info, 'GPSLatitudeRef')
             if gps_latitude and gps_latitude_ref:
@@ -586,9 +1433,8 @@ class ImageData(object):
             Returns the latitude and longitude, if available, from the 
             provided exif_data (obtained through get_exif_data above)
         """
-        # print(exif_data)
-        if self.exif_data and 'GPSInfo' in self.exif_data:
-            gps_info = self.exif_data["GPSInfo"]
+        gps_info = self._field('GPSInfo')
+        if gps_info is not None:
             gps_longitude = self.get_if_exist(gps_info, 'GPSLongitude')
             gps_longitude_ref = self.get_if_exist(gps_info, 'GPSLongitudeRef')
             if gps_longitude and gps_longitude_ref:
@@ -601,67 +1447,737 @@ class ImageData(object):
             return None
     
     def get_date_time(self):
-        if self.exif_data and 'DateTime' in self.exif_data:
-            date_and_time = self.exif_data['DateTime']
-            return date_and_time
+        return self._field('DateTime')
     
     def get_orig_date_time(self):
-        if self.exif_data and 'DateTimeOriginal' in self.exif_data:
-            date_and_time = self.exif_data['DateTimeOriginal']
-            return date_and_time
+        return self._field('DateTimeOriginal')
     
     def get_digi_date_time(self):
-        if self.exif_data and 'DateTimeDigitized' in self.exif_data:
-            date_and_time = self.exif_data['DateTimeDigitized']
-            return date_and_time
+        return self._field('DateTimeDigitized')
     
     def get_earliest_exif_date(self):
-        dt = self.get_date_time()
-        odt = self.get_orig_date_time()
-        ddt = self.get_digi_date_time()
-        if (dt is None or (odt is not None and odt < dt)):
-            dt = odt
-        if (dt is None or (ddt is not None and ddt < dt)):
-            dt = ddt
-        return dt
+        # earliest of the dates that parse (see parse_exif_date); if none do, the
+        # first one set, so the caller can tell the photo's date is malformed
+        earliest = None
+        for dt in (self.date, self.origdate, self.digidate):
+            parsed = parse_exif_date(dt)
+            if (parsed is not None and (earliest is None or parsed < earliest[0])):
+                earliest = (parsed, dt)
+        if (earliest is not None):
+            return earliest[1]
+        for dt in (self.date, self.origdate, self.digidate):
+            if (dt is not None):
+                return dt
+        return None
 
 
-####################   ArchiveMgr   #######################################
-class ArchiveMgr(object):
+####################   ArchiveCatalog   ###################################
+class ArchiveCatalog(object):
     '''
-        Class for managing archive folder tree, preventing duplicate entries, etc.
-        It maintains a HashDict, which is a cached data structure reflecting the
-        names and hashes of each file stored in each subfolder (yyyy\mm bucket).
-        This cache is automatically rehydrated when a request is made and the
-        files on disk do not reflect the current cache. This is relatively easy
-        since we don't need to deal with deletions, just additions.
+        Durable record of the files stored in an archive tree, kept in a small
+        SQLite database at the archive root. Each row is keyed by bucket and
+        file name and holds the size, mtime and hash of the file as it was when
+        it was last hashed. As long as a file's size and mtime still match, its
+        cached hash can be trusted without rereading the file. The hash
+        algorithm the archive uses is kept in the meta table under "algo".
+        A readonly catalog works on an in-memory copy of the database (empty if
+        there isn't one yet), so whatever is recorded is dropped on close.
     '''
-    NULLHASH = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
-    def __init__(self, root, hashdict=None):
-        self.Root = root
-        if (hashdict):
-            self.HashDict = hashdict
+    CATALOG_NAME = "_archive_catalog.sqlite"
+    COMMIT_EVERY = 500      # rows written between commits
+    def __init__(self, root, dbname=None, readonly=False):
+        self.DbFile = os.path.join(root, dbname or self.CATALOG_NAME)
+        # the connection may be shared by ArchiveWriter's copy threads, so
+        # every use of it goes through self.lock
+        if (readonly):
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            if (os.path.isfile(self.DbFile)):
+                source = sqlite3.connect(self.DbFile)     # only read from
+                source.backup(self.conn)
+                source.close()
         else:
-            self.HashDict = dict()
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            self.conn = sqlite3.connect(self.DbFile, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files ("
+                          "bucket TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+                          "mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL, PRIMARY KEY (bucket, name))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # perceptual hashes (see perceptual_hash), NULL for files that couldn't be decoded
+        self.conn.execute("CREATE TABLE IF NOT EXISTS phashes ("
+                          "bucket TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, "
+                          "mtime_ns INTEGER NOT NULL, phash INTEGER, PRIMARY KEY (bucket, name))")
+        self.conn.commit()
+        self.pending = 0
+        self.Entries = self.load()
+        self.PHashes = dict()
+        for (bucket, name, size, mtime_ns, phash) in self.conn.execute(
+                "SELECT bucket, name, size, mtime_ns, phash FROM phashes"):
+            if (phash is not None and phash < 0):
+                phash += 1 << 64    # stored signed, SQLite integers being 64-bit signed
+            self.PHashes.setdefault(bucket, dict())[name] = (size, mtime_ns, phash)
     
-    def submit_file_for_backup(self, infile, bucket, hash=None):
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+    
+    @classmethod
+    def stored_meta(cls, root, key, default=None, dbname=None):
+        # get_meta without opening (or creating) the catalog, e.g. the algo an archive uses
+        dbfile = os.path.join(root, dbname or cls.CATALOG_NAME)
+        if (not os.path.isfile(dbfile)):
+            return default
+        conn = sqlite3.connect(dbfile)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            row = None
+        finally:
+            conn.close()
+        return default if row is None else row[0]
+    
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            self.conn.commit()
+    
+    def load(self):
         '''
-        The method will see if its cache is current, and if not (i.e., there
-        are files on disk not in our HashDict), it will hash any unknown
-        files and add them to HashDict. If the hash of the input file matches
-        that of any file already archived, this is a duplicate, and will be
+            Read the whole catalog into memory
+            :return: dictionary[bucket] = dictionary[name] = (size, mtime_ns, hash)
+        '''
+        entries = dict()
+        for (bucket, name, size, mtime_ns, hash) in self.conn.execute(
+                "SELECT bucket, name, size, mtime_ns, hash FROM files"):
+            entries.setdefault(bucket, dict())[name] = (size, mtime_ns, hash)
+        return entries
+    
+    def lookup(self, bucket, name, st, algo=None):
+        '''
+            Return the cached hash of bucket\\name if the catalog entry still
+            matches the size and mtime in os.stat result st (and, if given, was
+            made with hash algorithm algo), otherwise None
+        '''
+        entry = self.Entries.get(bucket, {}).get(name)
+        if (entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns):
+            return None
+        if (algo is not None and digest_algo(entry[2]) != algo):
+            return None
+        return entry[2]
+    
+    def record(self, bucket, name, st, hash):
+        # write-through: update the in-memory copy and queue the row for the database
+        with self.lock:
+            self.Entries.setdefault(bucket, dict())[name] = (st.st_size, st.st_mtime_ns, hash)
+            self.conn.execute("INSERT OR REPLACE INTO files (bucket, name, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                              (bucket, name, st.st_size, st.st_mtime_ns, hash))
+            self.pending += 1
+            if (self.pending >= self.COMMIT_EVERY):
+                self.commit()
+    
+    def lookup_phash(self, bucket, name, st):
+        '''
+            :return: (True, perceptual hash or None if undecodable) if the catalog has
+            one for bucket\\name that still matches os.stat result st, else (False, None)
+        '''
+        entry = self.PHashes.get(bucket, {}).get(name)
+        if (entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime_ns):
+            return (False, None)
+        return (True, entry[2])
+    
+    def record_phash(self, bucket, name, st, phash):
+        with self.lock:
+            self.PHashes.setdefault(bucket, dict())[name] = (st.st_size, st.st_mtime_ns, phash)
+            if (phash is not None and phash >= 1 << 63):
+                phash -= 1 << 64
+            self.conn.execute("INSERT OR REPLACE INTO phashes (bucket, name, size, mtime_ns, phash) VALUES (?, ?, ?, ?, ?)",
+                              (bucket, name, st.st_size, st.st_mtime_ns, phash))
+            self.pending += 1
+            if (self.pending >= self.COMMIT_EVERY):
+                self.commit()
+    
+    def forget(self, bucket, name):
+        # drop the entry for a file that is no longer in the archive
+        with self.lock:
+            self.Entries.get(bucket, {}).pop(name, None)
+            self.PHashes.get(bucket, {}).pop(name, None)
+            self.conn.execute("DELETE FROM files WHERE bucket = ? AND name = ?", (bucket, name))
+            self.conn.execute("DELETE FROM phashes WHERE bucket = ? AND name = ?", (bucket, name))
+    
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+    
+    def close(self):
+        with self.lock:
+            if (self.conn is not None):
+                self.commit()
+                self.conn.close()
+                self.conn = None
+
+
+####################   BackupJournal   ####################################
+class BackupJournal(object):
+    '''
+        Write-ahead journal that lets an interrupted backup_photos run pick up
+        where it left off. It is a SQLite database at the archive root holding:
+        the index of the run once indexing has finished (run_pics, each photo
+        flagged once it has been archived or skipped), and the archive copies
+        that have been started but not finished (run_copies). Each copy's
+        intent is committed before any data is written. While indexing, a
+        SourceIndexCache next to it (CacheFile) checkpoints progress, so a
+        rerun doesn't reexamine the photos already indexed. It has a file of
+        its own, as the indexer may write to it while copies are journaled.
+        Both are deleted once the run completes.
+    '''
+    JOURNAL_NAME = "_backup_journal.sqlite"
+    COMMIT_EVERY = 500      # photos marked done between commits
+    def __init__(self, root, dbname=None):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.DbFile = os.path.join(root, dbname or self.JOURNAL_NAME)
+        self.CacheFile = self.DbFile + ".srccache"  # for the run's SourceIndexCache
+        # used by ArchiveWriter's copy threads too, so always through self.lock
+        self.conn = sqlite3.connect(self.DbFile, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS run_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS run_pics ("
+                          "seq INTEGER PRIMARY KEY, bucket TEXT, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                          "day INTEGER NOT NULL, hash TEXT, done INTEGER NOT NULL DEFAULT 0)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS run_pics_path ON run_pics (path)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS run_copies ("
+                          "bucket TEXT NOT NULL, name TEXT NOT NULL, source TEXT NOT NULL, PRIMARY KEY (bucket, name))")
+        self.conn.commit()
+        self.pending = 0
+    
+    def indexed(self):
+        # True if an earlier run got as far as saving its index
+        row = self.conn.execute("SELECT value FROM run_meta WHERE key = 'indexed'").fetchone()
+        return row is not None
+    
+    def save_index(self, pics):
+        '''
+            Checkpoint a finished index (a dictionary from index_pics, or a PhotoIndex)
+        '''
+        with self.lock:
+            self.conn.execute("DELETE FROM run_pics")
+            for bucket in pics:
+                if (pics[bucket] is None):
+                    continue
+                self.conn.executemany("INSERT INTO run_pics (bucket, path, size, day, hash) VALUES (?, ?, ?, ?, ?)",
+                                      ((bucket, fname, fsize, fdate.toordinal(), hash)
+                                       for (fname, fsize, fdate, hash) in pics[bucket]))
+            self.conn.execute("INSERT OR REPLACE INTO run_meta (key, value) VALUES ('indexed', '1')")
+            self.conn.commit()
+    
+    def load_index(self, columnar=False, algo=DEFAULT_HASH):
+        '''
+            Rebuild the saved index, leaving out photos already done
+            :return: dictionary[bucket] = list(PhotoRecord), or a PhotoIndex if columnar
+        '''
+        pics = PhotoIndex(algo) if columnar else dict()
+        for (bucket, path, size, day, hash) in self.conn.execute(
+                "SELECT bucket, path, size, day, hash FROM run_pics WHERE done = 0 ORDER BY seq"):
+            record = PhotoRecord(path, size, datetime.datetime.fromordinal(day), hash)
+            if (columnar):
+                pics.append(bucket, record)
+            else:
+                pics.setdefault(bucket, []).append(record)
+        return pics
+    
+    def pic_done(self, path):
+        # path has been archived (or found to be a dupe), a rerun can skip it
+        with self.lock:
+            self.conn.execute("UPDATE run_pics SET done = 1 WHERE path = ?", (path,))
+            self.pending += 1
+            if (self.pending >= self.COMMIT_EVERY):
+                self.commit()
+    
+    def begin_copy(self, bucket, name, source):
+        # record (durably) that bucket\\name is about to be written
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO run_copies (bucket, name, source) VALUES (?, ?, ?)",
+                              (bucket, name, source))
+            self.commit()
+    
+    def end_copy(self, bucket, name):
+        # bucket\\name is complete (or was cleaned up); committed along with later writes
+        with self.lock:
+            self.conn.execute("DELETE FROM run_copies WHERE bucket = ? AND name = ?", (bucket, name))
+    
+    def unfinished_copies(self):
+        # (bucket, name, source) of copies started but never finished
+        return self.conn.execute("SELECT bucket, name, source FROM run_copies").fetchall()
+    
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+    
+    def close(self):
+        with self.lock:
+            if (self.conn is not None):
+                self.commit()
+                self.conn.close()
+                self.conn = None
+    
+    def finish(self):
+        # the run completed: close and delete the journal and its source cache
+        self.close()
+        for filename in (self.DbFile, self.DbFile + "-wal", self.DbFile + "-shm",
+                         self.CacheFile, self.CacheFile + "-journal"):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+####################   CatalogSink   ######################################
+class CatalogSink(object):
+    '''
+        Optional copy of the run's results in a reporting database: one row per
+        indexed photo (path, bucket, size, date, hash, lat/lon) in photo_index,
+        and one per archived file in photo_archive. Rows are buffered and
+        written batchsize at a time with executemany over a single reused
+        connection (with pyodbc's fast_executemany where available), committing
+        once per batch. Use CatalogSink.odbc for a real database, or
+        CatalogSink.sqlite as a local stand-in. Safe to share between threads.
+    '''
+    TABLES = {
+        "photo_index": [("path", "VARCHAR(1024)"), ("bucket", "VARCHAR(32)"), ("size", "BIGINT"),
+                        ("ymd", "DATE"), ("hash", "VARCHAR(200)"), ("lat", "FLOAT"), ("lon", "FLOAT")],
+        "photo_archive": [("bucket", "VARCHAR(32)"), ("name", "VARCHAR(260)"), ("size", "BIGINT"),
+                          ("hash", "VARCHAR(200)"), ("source", "VARCHAR(1024)")],
+    }
+    def __init__(self, conn, batchsize=1000, fast=False, create=True):
+        '''
+            :param: conn (open DB-API connection using qmark parameters)
+            :param: batchsize (rows buffered per table before they are written)
+            :param: fast (set fast_executemany on the cursor, for pyodbc)
+            :param: create (create the tables, if the database doesn't have them yet)
+        '''
+        self.conn = conn
+        self.batchsize = batchsize
+        self.cursor = conn.cursor()
+        if (fast):
+            self.cursor.fast_executemany = True
+        self.lock = threading.Lock()
+        self.buffers = dict((table, []) for table in self.TABLES)
+        self.inserts = dict((table, "INSERT INTO {0} ({1}) VALUES ({2})".format(
+                            table, ", ".join(c for (c, t) in columns), ", ".join("?" * len(columns))))
+                            for (table, columns) in self.TABLES.items())
+        self.written = 0
+        if (create):
+            self.create_tables()
+    
+    @classmethod
+    def odbc(cls, connstr, batchsize=1000, **kwargs):
+        # sink on an ODBC database, e.g. "DRIVER={ODBC Driver 18 for SQL Server};SERVER=...;..."
+        if (pyodbc is None):
+            raise ValueError("CatalogSink.odbc needs pyodbc")
+        return cls(pyodbc.connect(connstr, autocommit=False), batchsize, fast=True, **kwargs)
+    
+    @classmethod
+    def sqlite(cls, filename, batchsize=1000, **kwargs):
+        # local stand-in for the ODBC sink, same tables and batching
+        return cls(sqlite3.connect(filename, check_same_thread=False), batchsize, **kwargs)
+    
+    def create_tables(self):
+        for (table, columns) in self.TABLES.items():
+            try:
+                self.cursor.execute("CREATE TABLE {0} ({1})".format(
+                    table, ", ".join("{0} {1}".format(c, t) for (c, t) in columns)))
+                self.conn.commit()
+            except Exception:
+                # most likely it already exists (not every database has IF NOT EXISTS)
+                self.conn.rollback()
+    
+    def add_photo(self, path, bucket, size, ymd, hash, lat=None, lon=None):
+        self._add("photo_index", (path, bucket, size, ymd.date() if ymd is not None else None, hash,
+                                  None if lat is None else float(lat), None if lon is None else float(lon)))
+    
+    def add_archived(self, bucket, name, size, hash, source):
+        self._add("photo_archive", (bucket, name, size, hash, source))
+    
+    def _add(self, table, row):
+        with self.lock:
+            buffer = self.buffers[table]
+            buffer.append(row)
+            if (len(buffer) >= self.batchsize):
+                self._write(table)
+    
+    def _write(self, table):
+        # write out and commit one table's buffered rows; call holding self.lock
+        rows = self.buffers[table]
+        if (rows):
+            self.cursor.executemany(self.inserts[table], rows)
+            self.conn.commit()
+            self.written += len(rows)
+            self.buffers[table] = []
+    
+    def flush(self):
+        with self.lock:
+            for table in self.buffers:
+                self._write(table)
+    
+    def close(self):
+        self.flush()
+        with self.lock:
+            if (self.conn is not None):
+                self.conn.close()
+                self.conn = None
+
+
+####################   ArchiveWriter   ####################################
+class ArchiveWriter(object):
+    '''
+        Concurrent front end to ArchiveMgr.submit_file_for_backup. Files are
+        checked for duplicates and given their archive names one at a time,
+        in the order submitted and under the bucket's lock, so dupes and
+        renames come out exactly as they would serially. The copies themselves
+        run on a pool of copy workers, with at most maxinflight bytes being
+        copied at once (a single larger file is still allowed on its own).
+    '''
+    def __init__(self, am, workers=4, maxinflight=256 * 1024 * 1024):
+        self.am = am
+        self.maxinflight = maxinflight
+        self.inflight = 0
+        self.cond = threading.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    
+    def submit(self, infile, bucket, hash=None, size=None):
+        '''
+            Queue infile for backup into bucket
+            :return: Future whose result is the submit_file_for_backup result list
+        '''
+        am = self.am
+        future = concurrent.futures.Future()
+        try:
+            if (size is None):
+                size = os.path.getsize(infile)
+            with am.bucket_lock(bucket):
+                result = am.check_file_for_backup(infile, bucket, hash, size)
+                if (result[0] != "NEW"):
+                    future.set_result(result)
+                    return future
+                hash = result[2]
+                safename = am._reserve_file_in_bucket(infile, bucket, hash, size)
+        except Exception as e:
+            print("Error preparing to copy file {0} to {1} -- {2}".format(infile, bucket, e))
+            future.set_result(["COPY_ERROR", None])
+            return future
+        self._acquire(size)
+        future = self.executor.submit(self._copy, infile, bucket, safename, hash, size)
+        return future
+    
+    def _copy(self, infile, bucket, safename, hash, size):
+        try:
+            return self.am._copy_into_bucket(infile, bucket, safename, hash)
+        finally:
+            self._release(size)
+    
+    def _acquire(self, size):
+        with self.cond:
+            while (self.inflight > 0 and self.inflight + size > self.maxinflight):
+                self.cond.wait()
+            self.inflight += size
+    
+    def _release(self, size):
+        with self.cond:
+            self.inflight -= size
+            self.cond.notify_all()
+    
+    def close(self):
+        # wait for every queued copy to finish
+        self.executor.shutdown(wait=True)
+
+
+####################   ArchiveMgr   #######################################
+class ArchiveMgr(object):
+    '''
+        Class for managing archive folder tree, preventing duplicate entries, etc.
+        It maintains a HashDict, which is a cached data structure reflecting the
+        names and hashes of each file stored in each subfolder (yyyy\mm bucket).
+        This cache is automatically rehydrated when a request is made and the
+        files on disk do not reflect the current cache. This is relatively easy
+        since we don't need to deal with deletions, just additions.
+        Unless disabled, an ArchiveCatalog under the root persists the hashes
+        between runs, so rehydrating only rehashes files that have changed.
+        With globaldedup, a HashIndex of hash -> (bucket, name) covering every
+        bucket in the archive is kept as well, so a file already stored under
+        any bucket is rejected as a dupe, and locate() can say where it is.
+        With sizefirst, archived files are only stat'ed when a bucket is
+        hydrated. A file is only hashed once another file of the same size
+        turns up, and then only after a cheap partial hash of its first and
+        last PARTIAL_BYTES also matches (see _size_first_dupe). Files copied in
+        unhashed are hashed as they are copied, so they are cataloged; the full
+        hashes of older files never compared are filled in by hash_remaining()
+        (or warm()). Files are hashed with the archive's algorithm, Algo (see HASHERS), which
+        is remembered in the catalog. An existing archive keeps its algorithm
+        unless rehash is given to switch it to algo (see archive_algo); then
+        cataloged digests made with the old one are treated as stale and
+        rehashed as their buckets are hydrated. A submitted hash from another
+        algorithm is recomputed.
+        With dryrun, nothing under Root is created or changed: the catalog is
+        read into memory, missing buckets aren't made, and plan_file_for_backup
+        is used instead of submit_file_for_backup.
+        With verifycopy, files are hashed as they are copied in and checked
+        against the source hash, and a copy that doesn't match is retried and
+        then rejected with VERIFY_ERROR.
+    '''
+    NULLHASH = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    PARTIAL_BYTES = 65536   # bytes hashed from each end of a file for its partial hash
+    COPY_RETRIES = 1        # extra attempts at a copy that fails verification
+    TEMP_SUFFIX = ".bkpart" # copies are written under this suffix, then renamed into place
+    NAMING = {"tilde": "{0}{2}{1}",     # IMG_0001~~.JPG: original scheme, '~' repeated count times
+              "numeric": "{0}_{3}{1}"}  # IMG_0001_2.JPG
+    def __init__(self, root, hashdict=None, catalog=True, globaldedup=False, sizefirst=False, algo=None,
+                 verifycopy=False, naming=None, journal=None, stats=None, neardupes=None, nearaction="report",
+                 sink=None, dryrun=False, rehash=False):
+        self.Root = root
+        self.DryRun = dryrun
+        if (hashdict):
+            self.HashDict = hashdict
+        else:
+            self.HashDict = dict()
+        # catalog may be True (use default catalog under root), False/None, or an ArchiveCatalog
+        if (catalog is True):
+            self.Catalog = ArchiveCatalog(root, readonly=dryrun)
+        else:
+            self.Catalog = catalog or None
+        # hash algorithm: whatever the catalog says the archive uses, unless rehash switches it
+        stored = self.Catalog.get_meta("algo") if self.Catalog is not None else None
+        self.Algo = archive_algo(stored, algo, rehash)
+        new_hasher(self.Algo)   # fail early on an unknown algorithm
+        if (self.Catalog is not None and self.Catalog.get_meta("algo") != self.Algo):
+            self.Catalog.set_meta("algo", self.Algo)
+        # how colliding names are made unique; like algo, an archive keeps the scheme it started with
+        if (naming is None and self.Catalog is not None):
+            naming = self.Catalog.get_meta("naming")
+        self.Naming = naming or "tilde"
+        if (self.Naming not in self.NAMING):
+            raise ValueError("Unknown naming scheme {0}".format(self.Naming))
+        if (self.Catalog is not None and self.Catalog.get_meta("naming") != self.Naming):
+            self.Catalog.set_meta("naming", self.Naming)
+        # names in use in each bucket (os.path.normcase'd), and per-stem collision
+        # counters, so a safe name is found without stat'ing candidates
+        self.Names = dict()         # bucket -> set of names
+        self.StemCounts = dict()    # bucket -> {normcased original name: next count to try}
+        # global hash -> (bucket, name) index, filled from every bucket on first use
+        self.HashIndex = None
+        self.IndexComplete = False
+        if (globaldedup):
+            self.HashIndex = dict()
+            for bucket in self.HashDict:
+                for (hash, name) in self.HashDict[bucket].items():
+                    self.HashIndex.setdefault(hash, (bucket, name))
+        # size-first dedup: SizeDict[bucket][size] = {name: hash, or None if not hashed yet}
+        self.SizeFirst = sizefirst
+        self.SizeDict = dict()
+        self.PartialDict = dict()   # (bucket, name) -> partial hash
+        self.CopyStrategies = collections.Counter()     # copy_file_fast strategy -> files copied
+        self.VerifyCopy = verifycopy
+        # for concurrent use (see ArchiveWriter): one lock per bucket guards that
+        # bucket's names and hashes, Lock guards everything shared between buckets
+        self.Lock = threading.RLock()
+        self.BucketLocks = dict()
+        self.InFlight = dict()      # (bucket, name) -> source file, while it is being copied there
+        # journal (a BackupJournal) of copies in progress, to clean up after a crash
+        self.Journal = journal
+        self.Stats = stats      # RunStats for the dedup, hydrate and copy stages, or None
+        # near-duplicates: photos whose perceptual hash is within neardupes bits of
+        # an archived photo's are reported, or with nearaction="skip", not archived
+        if (neardupes is not None and PILimage is None):
+            raise ValueError("neardupes needs PIL to decode images")
+        if (nearaction not in ("report", "skip")):
+            raise ValueError("Unknown nearaction {0}".format(nearaction))
+        self.NearDupes = neardupes
+        self.NearAction = nearaction
+        self.NearIndex = None       # BKTree of (bucket, name) by perceptual hash, built on first use
+        self.NearIndexLock = threading.Lock()   # held while NearIndex is built, instead of Lock
+        self.PendingPHash = dict()  # source file -> perceptual hash, until it is archived
+        self.Sink = sink            # CatalogSink told about every file archived, or None
+        if (self.Journal is not None):
+            self.recover()
+    
+    def recover(self):
+        '''
+            Remove what's left of copies an interrupted run started but didn't
+            finish (per the journal): temporary files, and any unconfirmed file
+            under the final name, so none of them is taken for an archived photo. The photos themselves are
+            still pending in the journal and will be copied again.
+            :return: number of unfinished copies cleaned up
+        '''
+        unfinished = self.Journal.unfinished_copies()
+        for (bucket, name, source) in unfinished:
+            fqname = os.path.join(self.Root, bucket, name)
+            for f in (fqname + self.TEMP_SUFFIX, fqname):
+                try:
+                    os.remove(f)
+                    print("Removed unfinished copy {0} (of {1})".format(f, source))
+                except OSError:
+                    pass
+            if (self.Catalog is not None):
+                self.Catalog.forget(bucket, name)
+            self.Journal.end_copy(bucket, name)
+        self.Journal.commit()
+        return len(unfinished)
+    
+    def bucket_lock(self, bucket):
+        with self.Lock:
+            return self.BucketLocks.setdefault(bucket, threading.RLock())
+    
+    def _archived_data(self, bucket, name):
+        # file holding the data of archived file bucket\\name: the source it is
+        # being copied from, if a concurrent copy hasn't finished, else itself.
+        # (Waiting for the copy instead could deadlock: the copy may still be
+        # queued behind others that need the bucket lock the caller holds.)
+        # :return: (file name, True if it is the source of a copy in flight)
+        source = self.InFlight.get((bucket, name))
+        if (source is not None):
+            return (source, True)
+        return (os.path.join(self.Root, bucket, name), False)
+    
+    def close(self):
+        # flush the catalog, if any; call when done submitting files
+        if (self.Catalog is not None):
+            self.Catalog.close()
+    
+    def submit_file_for_backup(self, infile, bucket, hash=None, size=None):
+        '''
+        The method will see if its cache is current, and if not (i.e., there
+        are files on disk not in our HashDict), it will hash any unknown
+        files and add them to HashDict. If the hash of the input file matches
+        that of any file already archived, this is a duplicate, and will be
         rejected with DUPE_ENTRY. Otherwise, the file will be copied to the
         archive tree in the bucket specified (avoiding any name collisions),
         and the new file name and hash will be added to the cached HashDict.
         :param infile: fully-qualified name of file to add
         :param bucket: yyyy\mm bucket (subfolder) to archive under
         :param hash: file hash (optional), will hash ourselves if not provided
-        :return: list of [status, stored_file_name
+        :param size: file size (optional), only used with sizefirst
+        :return: list of [status, stored_file_name (, copy strategy, on SUCCESS)]
         '''
+        with self.bucket_lock(bucket):
+            result = self.check_file_for_backup(infile, bucket, hash, size)
+            if (result[0] != "NEW"):
+                return result
+            # OK, this is a new file, so add it to archive and update the HashDict
+            return self._add_file_to_bucket(infile, bucket, result[2])
+    
+    def plan_file_for_backup(self, infile, bucket, hash=None, size=None):
+        '''
+        Dry-run counterpart of submit_file_for_backup: decide what would happen
+        to infile without copying it. A new file is given its archive name and
+        entered in the cache as if it had been copied (reading its data from
+        infile, like a copy in flight), so the files planned after it are
+        deduped and renamed against it just as they would be in a real run.
+        :return: ["COPY", stored_file_name] for a file that would be archived,
+        otherwise what submit_file_for_backup would return (DUPE_ENTRY, ...)
+        '''
+        with self.bucket_lock(bucket):
+            result = self.check_file_for_backup(infile, bucket, hash, size)
+            if (result[0] != "NEW"):
+                return result
+            hash = result[2]
+            if (size is None):
+                size = os.stat(infile).st_size
+            safename = self._gen_safe_filename(infile, bucket)
+            self.InFlight[(bucket, safename)] = infile
+            if (hash is not None):
+                self.HashDict.setdefault(bucket, dict())[hash] = safename
+            if (self.SizeFirst):
+                self.SizeDict.setdefault(bucket, dict()).setdefault(size, dict())[safename] = hash
+        with self.Lock:
+            phash = self.PendingPHash.pop(infile, None)
+            if (phash is not None):
+                self.NearIndex.add(phash, (bucket, safename))
+            if (hash is not None and self.HashIndex is not None):
+                self.HashIndex.setdefault(hash, (bucket, safename))
+        return ["COPY", os.path.join(self.Root, bucket, safename)]
+    
+    def check_file_for_backup(self, infile, bucket, hash=None, size=None):
+        '''
+        Everything submit_file_for_backup does short of copying: bring the
+        bucket's cache up to date and decide whether infile is a duplicate.
+        :return: ["NEW", None, hash] if infile should be archived (hash may be
+        None with sizefirst), otherwise ["DUPE_ENTRY", None] or ["INVALID_BUCKET", None]
+        '''
+        with StageTimer(self.Stats, "dedup"):
+            result = self._check_file(infile, bucket, hash, size)
+        if (result[0] == "NEW" and self.NearDupes is not None):
+            with StageTimer(self.Stats, "phash"):
+                result = self._check_near_dupe(infile, result)
+        return result
+    
+    def _check_near_dupe(self, infile, result):
+        # look for an archived photo that looks like infile, which exact dedup has passed
+        phash = perceptual_hash(infile)
+        if (phash is None):
+            return result
+        tree = self.near_index()
+        with self.Lock:
+            matches = tree.search(phash, self.NearDupes)
+            if (matches):
+                (distance, (mbucket, mname)) = matches[0]
+                print("Near duplicate: {0} looks like {1} (distance {2})".format(
+                    infile, os.path.join(self.Root, mbucket, mname), distance))
+                if (self.Stats is not None):
+                    # seen, that is; "near_dupe" counts the ones skipped (see _count_result)
+                    self.Stats.count("near_dupe_seen")
+                if (self.NearAction == "skip"):
+                    return ["NEAR_DUPE", None]
+            self.PendingPHash[infile] = phash
+        return result
+    
+    def near_index(self):
+        '''
+            BKTree of every archived photo's perceptual hash, built (from the
+            catalog where it can be) the first time it is needed. Building it
+            may decode every archived photo, so it is done holding only
+            NearIndexLock, and copies already under way carry on meanwhile.
+        '''
+        with self.NearIndexLock:
+            if (self.NearIndex is None):
+                tree = BKTree()
+                for bucket in self.list_buckets():
+                    for name in sorted(self._current_files_in_bucket(bucket)):
+                        phash = self._archived_phash(bucket, name)
+                        if (phash is not None):
+                            tree.add(phash, (bucket, name))
+                if (self.Catalog is not None):
+                    self.Catalog.commit()
+                with self.Lock:
+                    self.NearIndex = tree
+            return self.NearIndex
+    
+    def _archived_phash(self, bucket, name):
+        fqfile = os.path.join(self.Root, bucket, name)
+        try:
+            st = os.stat(fqfile)
+        except OSError:
+            return None
+        if (self.Catalog is not None):
+            (known, phash) = self.Catalog.lookup_phash(bucket, name, st)
+            if (known):
+                return phash
+        phash = perceptual_hash(fqfile)
+        if (self.Catalog is not None):
+            self.Catalog.record_phash(bucket, name, st, phash)
+        return phash
+    
+    def _check_file(self, infile, bucket, hash, size):
+        if (hash is not None and digest_algo(hash) != self.Algo):
+            hash = None     # made with a different algorithm, useless for comparison
+        if (self.SizeFirst):
+            return self._check_size_first(infile, bucket, hash, size)
         # if hash is provided (perhaps we already knew it due to earlier
         # workflow), just use it, otherwise hash it ourselves.
         if (hash is None):
-            hash = self.hash_file(infile)
+            hash = self.hash_file(infile, algo=self.Algo)
         # Get hash dictionary for this bucket
         if (bucket in self.HashDict):
             hashes = self.HashDict[bucket]
@@ -679,29 +2195,248 @@ class ArchiveMgr(object):
         if (hash in hashes):
             # this is a dupe
             return(["DUPE_ENTRY", None])
+        if (self.HashIndex is not None):
+            if (not self.IndexComplete):
+                self.hydrate_all()
+            if (hash in self.HashIndex):
+                # already stored, though perhaps under another bucket
+                return(["DUPE_ENTRY", None])
         # ok, we need to make sure the cache is current
         filestoupdate = self._uncached_files(bucket)
         if (len(filestoupdate) > 0):
             self._hydrate_bucket(bucket, filestoupdate)
         hashes = self.HashDict[bucket]
-        if (hash in hashes):
+        if (hash in hashes or (self.HashIndex is not None and hash in self.HashIndex)):
             # this is a dupe
             return(["DUPE_ENTRY", None])
-        # OK, this is a new file, so add it to archive and update the HashDict
-        # TODO
-        return self._add_file_to_bucket(infile, bucket)
+        return ["NEW", None, hash]
+    
+    def _check_size_first(self, infile, bucket, hash, size):
+        # check_file_for_backup for sizefirst archives; the source is only
+        # hashed if some archived file could be a duplicate of it
+        if (bucket not in self.HashDict):
+            if (not self._is_valid_bucket(bucket)):
+                print("Invalid bucket name: {0}".format(bucket))
+                return(["INVALID_BUCKET", None])
+            self.HashDict[bucket] = dict()
+        if (hash is not None and (hash in self.HashDict[bucket] or
+                                  (self.HashIndex is not None and hash in self.HashIndex))):
+            return(["DUPE_ENTRY", None])
+        if (self.HashIndex is not None and not self.IndexComplete):
+            self.hydrate_all()
+        filestoupdate = self._uncached_files(bucket)
+        if (len(filestoupdate) > 0):
+            self._hydrate_bucket(bucket, filestoupdate)
+        if (size is None):
+            size = os.stat(infile).st_size
+        (isdupe, hash) = self._size_first_dupe(infile, bucket, hash, size)
+        if (isdupe):
+            return(["DUPE_ENTRY", None])
+        return ["NEW", None, hash]
+    
+    def _size_first_dupe(self, infile, bucket, hash, size):
+        '''
+            Decide whether infile duplicates an archived file by comparing sizes
+            first, then partial hashes, and only then full hashes.
+            :return: (isdupe, hash), where hash is infile's full hash if it is
+            known or had to be computed, otherwise None
+        '''
+        partial = None
+        for (cbucket, cname) in self._size_candidates(bucket, size):
+            chash = self.SizeDict[cbucket][size][cname]
+            if (hash is None or chash is None):
+                # cheap check first: files whose partial hashes differ can't be dupes
+                if (partial is None):
+                    partial = self.partial_hash_file(infile, size, self.Algo)
+                if (self._archived_partial_hash(cbucket, cname, size) != partial):
+                    continue
+                if (chash is None):
+                    chash = self._fill_hash(cbucket, cname, size)
+                if (hash is None):
+                    hash = self.hash_file(infile, algo=self.Algo)
+            if (chash is not None and chash == hash):
+                return (True, hash)
+        return (False, hash)
+    
+    def _size_candidates(self, bucket, size):
+        # (bucket, name) of every archived file of this size that infile could duplicate
+        if (self.HashIndex is not None):
+            buckets = list(self.SizeDict)
+        else:
+            buckets = [bucket]
+        candidates = []
+        for b in buckets:
+            # copy workers add to other buckets as they finish
+            with self.bucket_lock(b):
+                candidates.extend((b, name) for name in self.SizeDict.get(b, {}).get(size, {}))
+        return candidates
+    
+    def _archived_partial_hash(self, bucket, name, size):
+        key = (bucket, name)
+        if (key not in self.PartialDict):
+            (datafile, inflight) = self._archived_data(bucket, name)
+            self.PartialDict[key] = self.partial_hash_file(datafile, size, self.Algo)
+        return self.PartialDict[key]
+    
+    def _fill_hash(self, bucket, name, size):
+        # compute and record the full hash of an archived file known so far only by size
+        fqfile = os.path.join(self.Root, bucket, name)
+        (datafile, inflight) = self._archived_data(bucket, name)
+        hash = self.hash_file(datafile, algo=self.Algo)
+        if (hash is None):
+            return None
+        with self.bucket_lock(bucket):
+            self.SizeDict[bucket][size][name] = hash
+            self.HashDict.setdefault(bucket, dict())[hash] = name
+        if (self.HashIndex is not None):
+            self.HashIndex.setdefault(hash, (bucket, name))
+        if (self.Catalog is not None and not inflight):
+            try:
+                self.Catalog.record(bucket, name, os.stat(fqfile), hash)
+            except OSError:
+                pass
+        return hash
+    
+    def hash_remaining(self):
+        '''
+            Compute the full hash of every archived file that sizefirst dedup has so
+            far only stat'ed, so the catalog holds a verified hash for the whole
+            archive. Can be run at any convenient time, e.g. after a backup.
+        '''
+        count = 0
+        for bucket in list(self.SizeDict):
+            for size in list(self.SizeDict[bucket]):
+                for (name, hash) in list(self.SizeDict[bucket][size].items()):
+                    if (hash is None):
+                        self._fill_hash(bucket, name, size)
+                        count += 1
+        if (self.Catalog is not None):
+            self.Catalog.commit()
+        return count
+    
+    @classmethod
+    def partial_hash_file(cls, file, size=None, algo=DEFAULT_HASH):
+        # cheap fingerprint: hash of the size and the first and last PARTIAL_BYTES of the file
+        try:
+            if (size is None):
+                size = os.stat(file).st_size
+            hash = new_hasher(algo)
+            hash.update(str(size).encode())
+            with open(file, 'rb') as f:
+                hash.update(f.read(cls.PARTIAL_BYTES))
+                if (size > 2 * cls.PARTIAL_BYTES):
+                    f.seek(-cls.PARTIAL_BYTES, os.SEEK_END)
+                    hash.update(f.read(cls.PARTIAL_BYTES))
+                elif (size > cls.PARTIAL_BYTES):
+                    hash.update(f.read())
+            return hash.hexdigest()
+        except:
+            return None
+    
+    def locate(self, hash):
+        '''
+            Return the fully-qualified name of the archived file with the given
+            hash, in whatever bucket it was stored, or None if it isn't archived.
+            Only available with globaldedup.
+        '''
+        if (self.HashIndex is None):
+            raise ValueError("locate() needs an ArchiveMgr created with globaldedup=True")
+        if (not self.IndexComplete):
+            self.hydrate_all()
+        where = self.HashIndex.get(hash)
+        if (where is None):
+            return None
+        return os.path.join(self.Root, where[0], where[1])
+    
+    def list_buckets(self):
+        # every folder under Root holding files is a bucket, named by its path relative to Root
+        buckets = []
+        for (dirpath, dirnames, filenames) in os.walk(self.Root):
+            if (filenames and os.path.normpath(dirpath) != os.path.normpath(self.Root)):
+                buckets.append(os.path.relpath(dirpath, self.Root))
+        return sorted(buckets)
+    
+    def hydrate_all(self):
+        # bring HashDict (and HashIndex) up to date for every bucket in the archive
+        for bucket in self.list_buckets():
+            filestoupdate = self._uncached_files(bucket)
+            if (len(filestoupdate) > 0):
+                self._hydrate_bucket(bucket, filestoupdate)
+        self.IndexComplete = True
+    
+    def warm(self, workers=4):
+        '''
+            Scan every bucket under Root and hash, workers at a time, each
+            archived file the catalog doesn't already know, so a backup that
+            follows only has to stat the archive. Unlike the lazy hydration
+            done by submit_file_for_backup, every file gets a full hash, even
+            with sizefirst.
+            :param: workers (number of files hashed at once)
+            :return: number of files hashed
+        '''
+        tohash = []     # (bucket, name, stat) of files the catalog can't answer for
+        for bucket in self.list_buckets():
+            if (self.SizeFirst):
+                # files sizefirst has seen but not hashed count as uncached here
+                known = set(name for names in self.SizeDict.get(bucket, {}).values()
+                            for (name, hash) in names.items() if hash is not None)
+                files = self._current_files_in_bucket(bucket) - known
+            else:
+                files = self._uncached_files(bucket)
+            for name in sorted(files):
+                fqfile = os.path.join(self.Root, bucket, name)
+                try:
+                    st = os.stat(fqfile)
+                except OSError as e:
+                    print("Error examining archived file {0} -- {1}".format(fqfile, e))
+                    continue
+                hash = None
+                if (self.Catalog is not None):
+                    hash = self.Catalog.lookup(bucket, name, st, self.Algo)
+                if (hash is None):
+                    tohash.append((bucket, name, st))
+                else:
+                    self._store_archived_hash(bucket, name, st, hash)
+        workers = max(1, workers or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = executor.map(self._warm_hash, tohash)
+            for ((bucket, name, st), hash) in zip(tohash, hashes):
+                if (hash is None):
+                    print("Error hashing archived file {0}".format(os.path.join(self.Root, bucket, name)))
+                    continue
+                self._store_archived_hash(bucket, name, st, hash)
+                if (self.Catalog is not None):
+                    self.Catalog.record(bucket, name, st, hash)
+        self.IndexComplete = True
+        if (self.Catalog is not None):
+            self.Catalog.commit()
+        return len(tohash)
+    
+    def _warm_hash(self, job):
+        (bucket, name, st) = job
+        with StageTimer(self.Stats, "hydrate", st.st_size):
+            return self.hash_file(os.path.join(self.Root, bucket, name), algo=self.Algo)
+    
+    def _store_archived_hash(self, bucket, name, st, hash):
+        # note the hash of an archived file everywhere it is looked up
+        with self.bucket_lock(bucket):
+            self.HashDict.setdefault(bucket, dict())[hash] = name
+            if (self.SizeFirst):
+                self.SizeDict.setdefault(bucket, dict()).setdefault(st.st_size, dict())[name] = hash
+        if (self.HashIndex is not None):
+            self.HashIndex.setdefault(hash, (bucket, name))
     
     @staticmethod
-    def hash_file(file, bufsize = 262144):
+    def hash_file(file, bufsize = 262144, algo = DEFAULT_HASH):
         try:
-            hash = hashlib.sha256()
+            hash = new_hasher(algo)
             with open(file, 'rb') as f:
                 while True:
                     data = f.read(bufsize)
                     if not data:
                         break
                     hash.update(data)
-            return hash.hexdigest()
+            return tag_digest(algo, hash.hexdigest())
         except:
             return None
     
@@ -726,30 +2461,189 @@ class ArchiveMgr(object):
     def file_exists(f, dir):
         return os.path.isfile(os.path.join(dir, os.path.basename(f)))
     
-    @staticmethod
-    def _gen_safe_filename(file, folder, addchar = '~'):
-        # given a base file name, return unchanged if it doesn't exist in folder
-        # If it does exist, append a tilde (~) to the end (before extension) until no files match it.
-        if not ArchiveMgr.file_exists(os.path.basename(file), folder):
-            return file
-        else:
-            base, ext = os.path.splitext(os.path.basename(file))
-            newfile = base + addchar + ext
-            return ArchiveMgr._gen_safe_filename(newfile, folder, addchar)
+    def _gen_safe_filename(self, file, bucket, addchar = '~'):
+        # given a base file name, return unchanged if it isn't in use in bucket.
+        # If it is, add a tilde (~) to the end (before extension), or _N with the
+        # numeric scheme, counting up until the name is free. The name is claimed
+        # in Names; call _forget_name if it ends up unused.
+        names = self._names_in_bucket(bucket)
+        file = os.path.basename(file)
+        base, ext = os.path.splitext(file)
+        stem = os.path.normcase(file)
+        counts = self.StemCounts.setdefault(bucket, dict())
+        count = counts.get(stem, 0)
+        pattern = self.NAMING[self.Naming]
+        while True:
+            if (count == 0):
+                newfile = file
+            else:
+                newfile = pattern.format(base, ext, addchar * count, count)
+            if (os.path.normcase(newfile) not in names):
+                break
+            count += 1
+        counts[stem] = count + 1
+        names.add(os.path.normcase(newfile))
+        return newfile
     
-    def _add_file_to_bucket(self, infile, bucket):
+    def _names_in_bucket(self, bucket):
+        # set of (normcased) names in use in bucket, listed from disk the first time
+        if (bucket not in self.Names):
+            self.Names[bucket] = set(os.path.normcase(name) for name in self._current_files_in_bucket(bucket))
+        return self.Names[bucket]
+    
+    def _forget_name(self, bucket, name):
+        # give back a name claimed by _gen_safe_filename but never stored
+        self.Names.get(bucket, set()).discard(os.path.normcase(name))
+        self.StemCounts.get(bucket, {}).clear()     # earlier counts may now skip a free name
+    
+    def _add_file_to_bucket(self, infile, bucket, hash=None):
         # generate unique file name and store it in bucket, return new file name
-        fdfolder = safename = fqsafename = "*UNDEF*"    # in case we bomb before setting them in try block
+        fqfolder = safename = "*UNDEF*"    # in case we bomb before setting them in try block
         try:
             fqfolder = os.path.join(self.Root, bucket)
             #print("DEBUG:  In _add_file_to_bucket, fqfolder is {0}".format(fqfolder))
-            safename = ArchiveMgr._gen_safe_filename(os.path.basename(infile), fqfolder)
-            fqsafename = os.path.join(fqfolder, safename)
-            shutil.copy2(infile, fqsafename)
-            return ["SUCCESS", fqsafename]
+            safename = self._gen_safe_filename(infile, bucket)
         except Exception as e:
             print("Error copying file {0} as {1} to {2} -- {3}".format(infile, safename, fqfolder, e))
             return ["COPY_ERROR", None]
+        return self._copy_into_bucket(infile, bucket, safename, hash)
+    
+    def _reserve_file_in_bucket(self, infile, bucket, hash, size):
+        '''
+            First half of _add_file_to_bucket, for concurrent copies: pick the
+            file's archive name and claim it in the cache before the data is
+            copied, so files checked after it see it as if the copy had already
+            happened. Nothing is written under the name until the copy lands (see
+            _copy_into_bucket), so a crash can't leave an empty file there.
+            Must be called holding the bucket's lock.
+            :return: safe file name, to pass to _copy_into_bucket
+        '''
+        safename = self._gen_safe_filename(infile, bucket)
+        if (self.Journal is not None):
+            try:
+                self.Journal.begin_copy(bucket, safename, infile)
+            except:
+                self._forget_name(bucket, safename)
+                raise
+        self.InFlight[(bucket, safename)] = infile
+        if (hash is not None):
+            self.HashDict.setdefault(bucket, dict())[hash] = safename
+            if (self.HashIndex is not None):
+                with self.Lock:
+                    self.HashIndex.setdefault(hash, (bucket, safename))
+        if (self.SizeFirst):
+            self.SizeDict.setdefault(bucket, dict()).setdefault(size, dict())[safename] = hash
+        return safename
+    
+    def _release_reservation(self, bucket, safename, hash):
+        # undo _reserve_file_in_bucket after a failed copy
+        with self.bucket_lock(bucket):
+            if (hash is not None and self.HashDict.get(bucket, {}).get(hash) == safename):
+                del self.HashDict[bucket][hash]
+            if (hash is not None and self.HashIndex is not None):
+                with self.Lock:
+                    if (self.HashIndex.get(hash) == (bucket, safename)):
+                        del self.HashIndex[hash]
+            for names in self.SizeDict.get(bucket, {}).values():
+                names.pop(safename, None)
+            try:
+                # in case the copy failed after it was renamed into place
+                os.remove(os.path.join(self.Root, bucket, safename))
+            except OSError:
+                pass
+            self._forget_name(bucket, safename)
+    
+    def _copy_into_bucket(self, infile, bucket, safename, hash):
+        # second half of _add_file_to_bucket: copy the data and record the new file
+        fqfolder = os.path.join(self.Root, bucket)
+        fqsafename = os.path.join(fqfolder, safename)
+        fqtemp = fqsafename + self.TEMP_SUFFIX    # the data only appears under fqsafename once complete
+        reserved = (bucket, safename) in self.InFlight
+        with StageTimer(self.Stats, "copy") as timer:
+            try:
+                if (self.Journal is not None and not reserved):
+                    self.Journal.begin_copy(bucket, safename, infile)
+                if (self.VerifyCopy):
+                    expected = hash
+                    (strategy, hash) = self._copy_verified(infile, fqtemp, hash)
+                    if (strategy is None):
+                        if (reserved):
+                            self._release_reservation(bucket, safename, expected)
+                            self.InFlight.pop((bucket, safename), None)
+                        else:
+                            self._forget_name(bucket, safename)
+                        if (self.Journal is not None):
+                            self.Journal.end_copy(bucket, safename)
+                        self.PendingPHash.pop(infile, None)
+                        return ["VERIFY_ERROR", None]
+                elif (hash is None):
+                    # sizefirst never needed this file's hash; take it on the way
+                    # through, so the copy is cataloged like any other
+                    hash = copy_file_hashed(infile, fqtemp, self.Algo)
+                    strategy = "hashed"
+                else:
+                    strategy = copy_file_fast(infile, fqtemp)
+                os.replace(fqtemp, fqsafename)
+                st = os.stat(fqsafename)
+                with self.bucket_lock(bucket):
+                    if (hash is not None):
+                        # we know what we just wrote, so it never needs rehydrating
+                        self.HashDict.setdefault(bucket, dict())[hash] = safename
+                    if (self.SizeFirst):
+                        names = self.SizeDict.setdefault(bucket, dict()).setdefault(st.st_size, dict())
+                        if (names.get(safename) is None):
+                            names[safename] = hash
+                    self.InFlight.pop((bucket, safename), None)
+                with self.Lock:
+                    self.CopyStrategies[strategy] += 1
+                    phash = self.PendingPHash.pop(infile, None)
+                    if (phash is not None):
+                        self.NearIndex.add(phash, (bucket, safename))
+                        if (self.Catalog is not None):
+                            self.Catalog.record_phash(bucket, safename, st, phash)
+                    if (hash is not None):
+                        if (self.Catalog is not None):
+                            # write through, so later runs only need a stat
+                            self.Catalog.record(bucket, safename, st, hash)
+                        if (self.HashIndex is not None):
+                            self.HashIndex.setdefault(hash, (bucket, safename))
+                if (self.Journal is not None):
+                    self.Journal.end_copy(bucket, safename)
+                if (self.Sink is not None):
+                    self.Sink.add_archived(bucket, safename, st.st_size, hash, infile)
+                timer.nbytes = st.st_size
+                return ["SUCCESS", fqsafename, strategy]
+            except Exception as e:
+                print("Error copying file {0} as {1} to {2} -- {3}".format(infile, safename, fqfolder, e))
+                self.PendingPHash.pop(infile, None)
+                try:
+                    os.remove(fqtemp)
+                except OSError:
+                    pass
+                if (self.Journal is not None):
+                    self.Journal.end_copy(bucket, safename)
+                if (reserved):
+                    self._release_reservation(bucket, safename, hash)
+                    self.InFlight.pop((bucket, safename), None)
+                elif (not os.path.exists(fqsafename)):
+                    self._forget_name(bucket, safename)
+                return ["COPY_ERROR", None]
+    
+    def _copy_verified(self, infile, fqname, expected):
+        '''
+            Copy infile to fqname, hashing the data on its way through. If it
+            doesn't match the expected hash (when one is known), the copy is
+            retried COPY_RETRIES times before being removed.
+            :return: (strategy, hash), or (None, None) if it couldn't be verified
+        '''
+        for attempt in range(1 + self.COPY_RETRIES):
+            hash = copy_file_hashed(infile, fqname, self.Algo)
+            if (expected is None or hash == expected):
+                return ("verified", hash)
+            print("Hash mismatch copying {0} to {1} (attempt {2}): expected {3}, got {4}".format(
+                infile, fqname, attempt + 1, expected, hash))
+        os.remove(fqname)
+        return (None, None)
     
     def _hydrate_bucket(self, bucket, files):
         # Might be new bucket altogether
@@ -759,12 +2653,53 @@ class ArchiveMgr(object):
             hdict = dict()
         for file in files:
             fqfile = os.path.join(self.Root, bucket, file)
-            hash = self.hash_file(fqfile)
+            with StageTimer(self.Stats, "hydrate"):
+                if (self.SizeFirst):
+                    # just note its size; hash it only if a same-sized file turns up
+                    hash = self._register_by_size(bucket, file, fqfile)
+                else:
+                    hash = self._archived_file_hash(bucket, file, fqfile)
+            if (hash is None and self.SizeFirst):
+                continue
             hdict[hash] = os.path.basename(fqfile)
+            if (self.HashIndex is not None and hash is not None):
+                self.HashIndex.setdefault(hash, (bucket, hdict[hash]))
         self.HashDict[bucket] = hdict   # update
     
+    def _archived_file_hash(self, bucket, file, fqfile):
+        # hash of a file already in the archive, from the catalog if its size and mtime still match
+        if (self.Catalog is None):
+            return self.hash_file(fqfile, algo=self.Algo)
+        try:
+            st = os.stat(fqfile)
+        except OSError:
+            return self.hash_file(fqfile, algo=self.Algo)
+        hash = self.Catalog.lookup(bucket, file, st, self.Algo)
+        if (hash is None):
+            hash = self.hash_file(fqfile, algo=self.Algo)
+            if (hash is not None):
+                self.Catalog.record(bucket, file, st, hash)
+        return hash
+    
+    def _register_by_size(self, bucket, file, fqfile):
+        # add an archived file to SizeDict, returning its hash if the catalog already knows it
+        try:
+            st = os.stat(fqfile)
+        except OSError as e:
+            print("Error examining archived file {0} -- {1}".format(fqfile, e))
+            return None
+        hash = None
+        if (self.Catalog is not None):
+            hash = self.Catalog.lookup(bucket, file, st, self.Algo)
+        self.SizeDict.setdefault(bucket, dict()).setdefault(st.st_size, dict())[file] = hash
+        return hash
+    
     def _uncached_files(self, bucket):
-        if (bucket in self.HashDict):
+        if (self.SizeFirst):
+            setcachedfiles = set()
+            for names in self.SizeDict.get(bucket, {}).values():
+                setcachedfiles.update(names)
+        elif (bucket in self.HashDict):
             setcachedfiles = set(self.HashDict[bucket].values())
         else:
             setcachedfiles = set()
@@ -779,101 +2714,551 @@ class ArchiveMgr(object):
             folder = os.path.join(self.Root, bucket)
             #print("DEBUG: in _current_files_in_bucket, folder is {0}".format(folder))
             if (os.path.isdir(folder)):
-                return set(os.listdir(folder))
+                # copies still being written (or torn by a crash) aren't archive members
+                files = set(name for name in os.listdir(folder) if not name.endswith(self.TEMP_SUFFIX))
+                if (bucket in self.Names):
+                    # pick up anything that appeared behind our back
+                    self.Names[bucket].update(os.path.normcase(name) for name in files)
+                return files
             else:
                 # new folder?
-                ArchiveMgr.makedir(folder)
+                if (not self.DryRun):
+                    ArchiveMgr.makedir(folder)
                 return set()    # nothing there
         except Exception as e:
             print("Error getting _current_files_in_bucket({0}, {1}), returning null set -- {2}".format(self.Root, bucket, e))
             return set()
     
 
+####################   SourceIndexCache   ####################################################
+class SourceIndexCache(object):
+    '''
+        Persistent cache of PhotoIndexer results, kept in a SQLite database.
+        Each row is keyed by the source path and remembers the size, mtime and
+        inode the file had when it was indexed, along with the computed ymd,
+        bucket and hash (NULL if it was indexed with lazyhash). A file whose
+        stat still matches is answered from the cache without opening it.
+    '''
+    COMMIT_EVERY = 500      # rows written between commits
+    def __init__(self, dbfile):
+        self.DbFile = dbfile
+        # the indexer may run on a background thread (see stream_pics_to_backup),
+        # but only ever one thread at a time uses the connection
+        self.conn = sqlite3.connect(dbfile, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS pics ("
+                          "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                          "inode INTEGER NOT NULL, ymd TEXT NOT NULL, bucket TEXT NOT NULL, hash TEXT)")
+        self.conn.commit()
+        self.pending = 0
+    
+    def lookup(self, path, st):
+        '''
+            Return the cached (ymd, bucket, hash) for path if its size, mtime and
+            inode still match os.stat result st, otherwise None
+        '''
+        row = self.conn.execute("SELECT size, mtime_ns, inode, ymd, bucket, hash FROM pics WHERE path = ?",
+                                (path,)).fetchone()
+        if (row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns or row[2] != st.st_ino):
+            return None
+        ymd = datetime.datetime.strptime(row[3], "%Y-%m-%d")
+        return (ymd, row[4], row[5])
+    
+    def record(self, path, st, ymd, bucket, hash):
+        self.conn.execute("INSERT OR REPLACE INTO pics (path, size, mtime_ns, inode, ymd, bucket, hash) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (path, st.st_size, st.st_mtime_ns, st.st_ino, ymd.strftime("%Y-%m-%d"), bucket, hash))
+        self.pending += 1
+        if (self.pending >= self.COMMIT_EVERY):
+            self.commit()
+    
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+    
+    def close(self):
+        if (self.conn is not None):
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+
+####################   PhotoRecord   #########################################################
+class PhotoRecord(object):
+    '''
+        Compact index entry for one photo. The folder name is interned, so
+        photos in the same folder share it, the date is kept as a day ordinal
+        and the hash as raw digest bytes (plus the interned algorithm name).
+        A record still behaves like the [filename, size, ymd, hash] list
+        index_pics used to produce: it unpacks, indexes and compares as one.
+    '''
+    __slots__ = ('folder', 'name', 'size', 'day', 'algo', 'digest')
+    def __init__(self, filename, size, ymd, hash):
+        (folder, name) = os.path.split(filename)
+        self.folder = sys.intern(folder)
+        self.name = name
+        self.size = size
+        self.day = ymd.toordinal()
+        (self.algo, self.digest) = PhotoRecord.pack_digest(hash)
+    
+    @staticmethod
+    def pack_digest(hash):
+        # stored (possibly tagged) hex digest -> (interned algo, raw bytes), (None, None) for no hash
+        if (hash is None):
+            return (None, None)
+        return (sys.intern(digest_algo(hash)), bytes.fromhex(hash.rpartition(':')[2]))
+    
+    @staticmethod
+    def unpack_digest(algo, digest):
+        if (digest is None):
+            return None
+        return tag_digest(algo, digest.hex())
+    
+    @property
+    def filename(self):
+        return os.path.join(self.folder, self.name)
+    
+    @property
+    def ymd(self):
+        return datetime.datetime.fromordinal(self.day)
+    
+    @property
+    def hash(self):
+        return PhotoRecord.unpack_digest(self.algo, self.digest)
+    
+    def __iter__(self):
+        return iter((self.filename, self.size, self.ymd, self.hash))
+    
+    def __getitem__(self, i):
+        return tuple(self)[i]
+    
+    def __len__(self):
+        return 4
+    
+    def __eq__(self, other):
+        return list(self) == list(other)
+    
+    def __repr__(self):
+        return "PhotoRecord({0!r}, {1}, {2!r}, {3!r})".format(self.filename, self.size, self.ymd, self.hash)
+    
+
+####################   PhotoIndex   ##########################################################
+class PhotoIndex(object):
+    '''
+        Columnar alternative to the dictionary built by index_pics, for very
+        large trees. Each bucket keeps its photos as parallel arrays: folder
+        number, size, day ordinal and a flag for "has a hash", plus a list of
+        names and one bytearray holding every digest back to back. Folder
+        names are stored once for the whole index. Reading is through the same
+        interface as the dictionary: pics[bucket] is a sequence of PhotoRecords.
+        All hashes must come from the same algorithm.
+    '''
+    def __init__(self, algo=DEFAULT_HASH):
+        self.algo = algo
+        self.digestsize = new_hasher(algo).digest_size
+        self.folders = []       # folder number -> folder name
+        self.foldernums = {}    # folder name -> folder number
+        self.buckets = {}       # bucket -> PhotoBucket
+    
+    def append(self, bucket, entry):
+        # add a photo, given as a PhotoRecord or [filename, size, ymd, hash]
+        if (bucket not in self.buckets):
+            self.buckets[bucket] = PhotoBucket(self)
+        self.buckets[bucket].append(*entry)
+    
+    def folder_number(self, folder):
+        num = self.foldernums.get(folder)
+        if (num is None):
+            num = self.foldernums[folder] = len(self.folders)
+            self.folders.append(folder)
+        return num
+    
+    def __getitem__(self, bucket):
+        return self.buckets[bucket]
+    
+    def __contains__(self, bucket):
+        return bucket in self.buckets
+    
+    def __iter__(self):
+        return iter(self.buckets)
+    
+    def __len__(self):
+        return len(self.buckets)
+    
+    def keys(self):
+        return self.buckets.keys()
+    
+    def items(self):
+        return self.buckets.items()
+    
+    def values(self):
+        return self.buckets.values()
+    
+
+class PhotoBucket(object):
+    # one bucket's columns in a PhotoIndex; a read-only sequence of PhotoRecords
+    def __init__(self, index):
+        self.index = index
+        self.foldernums = array.array('L')
+        self.names = []
+        self.sizes = array.array('q')
+        self.days = array.array('l')
+        self.hashed = array.array('b')
+        self.digests = bytearray()
+    
+    def append(self, filename, size, ymd, hash):
+        (folder, name) = os.path.split(filename)
+        self.foldernums.append(self.index.folder_number(folder))
+        self.names.append(name)
+        self.sizes.append(size)
+        self.days.append(ymd.toordinal())
+        (algo, digest) = PhotoRecord.pack_digest(hash)
+        if (digest is not None and (algo != self.index.algo or len(digest) != self.index.digestsize)):
+            raise ValueError("PhotoIndex for {0} can't hold a {1} hash".format(self.index.algo, algo))
+        self.hashed.append(digest is not None)
+        self.digests += digest or bytes(self.index.digestsize)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if (i < 0):
+            i += len(self)
+        record = PhotoRecord.__new__(PhotoRecord)
+        record.folder = self.index.folders[self.foldernums[i]]
+        record.name = self.names[i]
+        record.size = self.sizes[i]
+        record.day = self.days[i]
+        if (self.hashed[i]):
+            width = self.index.digestsize
+            record.algo = self.index.algo
+            record.digest = bytes(self.digests[i * width:(i + 1) * width])
+        else:
+            record.algo = record.digest = None
+        return record
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+
 ####################   PhotoIndexer   ########################################################
 class PhotoIndexer(object):
-    def __init__(self, root, spec= "**\\*.jpg"):
+    EXTENSIONS = (".jpg", ".jpeg", ".heic", ".png", ".raw")    # indexed by default, in any case
+    def __init__(self, root, spec=None, cache=None, verify=False, workers=0, pool="thread",
+                 lazyhash=False, algo=DEFAULT_HASH, extensions=None, stats=None, sink=None):
+        '''
+            :param: root (top of the source tree to index)
+            :param: spec (glob spec, relative to root, of the files to index, e.g. "**\\*.jpg";
+                    None walks the tree with os.scandir instead, see walk_pics)
+            :param: cache (SourceIndexCache, or the name of its database file; None for no cache)
+            :param: verify (if True, ignore cached results and re-examine every file, refreshing the cache)
+            :param: workers (number of files to examine concurrently; 0 or 1 examines them serially)
+            :param: pool ("thread" or "process", the kind of worker pool to use when workers > 1)
+            :param: lazyhash (if True, don't hash files; entries get a hash of None and an
+                    ArchiveMgr using sizefirst hashes them only if it needs to)
+            :param: algo (hash algorithm, see HASHERS; should match the archive's)
+            :param: extensions (file extensions to index when spec is None, matched
+                    case-insensitively; default EXTENSIONS)
+            :param: stats (RunStats to record the walk, stat, exif and hash stages in, or None)
+            :param: sink (CatalogSink to add a row to for each photo indexed, or None)
+        '''
         self.picroot = root
         self.filterfn = None
+        self.dirfilterfn = None
         self.spec = spec
+        self.stats = stats
+        self.sink = sink
+        self.wantgps = (sink is not None)   # only the sink uses the GPS position, which is parsed separately
+        self.extensions = frozenset(("." + ext.lstrip(".")).lower() for ext in (extensions or self.EXTENSIONS))
+        if (isinstance(cache, str)):
+            cache = SourceIndexCache(cache)
+        self.cache = cache
+        self.verify = verify
+        self.workers = workers
+        self.pool = pool
+        self.lazyhash = lazyhash
+        self.algo = algo
+        new_hasher(algo)    # fail early on an unknown algorithm
+        self.count = 0
     
-    def set_filterfn(self, fn):
+    def __getstate__(self):
+        # a process pool pickles the indexer to run _examine; the cache connection
+        # and filter function stay behind, workers don't need them
+        state = self.__dict__.copy()
+        state['cache'] = None
+        state['filterfn'] = None
+        state['dirfilterfn'] = None
+        state['stats'] = None
+        state['sink'] = None
+        return state
+    
+    def set_filterfn(self, fn, dirfn=None):
         '''
             Set a file filter function for this instance
             :param: fn (function that takes a fully-qualified file name and returns a boolean)
+            :param: dirfn (function that takes a folder name and returns False if no file
+                    under it can pass fn, so the walk needn't enter it; defaults to
+                    fn.ok_dir if fn has one, see ok_to_descend)
         '''
         self.filterfn = fn
+        if (dirfn is None):
+            dirfn = getattr(fn, "ok_dir", None)
+        self.dirfilterfn = dirfn
     
-    def index_pics(self): 
+    def index_pics(self, columnar=False): 
         '''
         Given a location in self.picroot, a glob spec in self.spec, and a file filter
         function in self.filterfn, examine all qualifying photos in the tree. Hash and
         categorize them into yyyy\mm date buckets. Return a dictionary keyed by date bucket,
-        with the bucket values being a list of entries. Each entry is a list of [filename, size, ymd, hash]
+        with the bucket values being a list of entries. Each entry is a PhotoRecord, which
+        unpacks like the list [filename, size, ymd, hash]
+        :param: columnar (if True, return a PhotoIndex, which stores the same entries in
+                far less memory)
         :return: dictionary[bucket] = list([filename, size, ymd, hash])
         '''
-        pics_by_date = {}
-        count = 0
-        for pic in glob.iglob(os.path.join(self.picroot, self.spec), recursive=True):
-            if (self.filterfn == None or self.filterfn(pic)):   #run pic through filter function, only process if passes
-                count += 1
-                try:
-                    size = os.stat(pic).st_size
-                    ymd = self._image_date(pic)
-                    bucket = self._bucket_from_date(ymd)  # key for dictionary (yyyy\mm)
-                    fingerprint = self.hash_file(pic)
-                    entry = [pic, size, ymd, fingerprint]
-                    if bucket in pics_by_date:
-                        pics_by_date[bucket].append(entry)
-                    else:
-                        pics_by_date[bucket] = [entry]
-                except Exception as e:
-                    print("Error examining file '{0}' -- {1}".format(pic, e))
-                if (count % 100 == 0):
-                    print("Indexing count: {0}".format(count))
-        print("Total of {0} photo(s) indexed into {1} monthly bucket(s)".format(count, len(pics_by_date)))
+        if (columnar):
+            pics_by_date = PhotoIndex(self.algo)
+        else:
+            pics_by_date = {}
+        for (bucket, entry) in self.iter_pics():
+            if (columnar):
+                pics_by_date.append(bucket, entry)
+            elif bucket in pics_by_date:
+                pics_by_date[bucket].append(entry)
+            else:
+                pics_by_date[bucket] = [entry]
+        print("Total of {0} photo(s) indexed into {1} monthly bucket(s)".format(self.count, len(pics_by_date)))
         return pics_by_date
     
+    def iter_pics(self):
+        '''
+        Generator form of index_pics. Yields (bucket, PhotoRecord) for each
+        photo as soon as it has been examined, in walk order, so a consumer can act on it
+        without waiting for the whole tree to be indexed. When exhausted, self.count holds
+        the number of files examined.
+        '''
+        self.count = 0
+        executor = self._make_executor()
+        # jobs are collected strictly in the order they were started, so the
+        # result is the same however many workers there are
+        pending = collections.deque()
+        window = max(1, self.workers) * 8     # bound on files in flight
+        try:
+            if (self.spec is None):
+                pics = self.walk_pics()
+            else:
+                pics = ((pic, None) for pic in glob.iglob(os.path.join(self.picroot, self.spec), recursive=True))
+            pics = self._timed_walk(pics)
+            for (pic, st) in pics:
+                if (self.filterfn == None or self.filterfn(pic)):   #run pic through filter function, only process if passes
+                    pending.append(self._start(pic, executor, st))
+                    if (len(pending) >= window):
+                        item = self._collect(pending.popleft())
+                        if (item is not None):
+                            yield item
+            while pending:
+                item = self._collect(pending.popleft())
+                if (item is not None):
+                    yield item
+        finally:
+            if (executor is not None):
+                executor.shutdown(cancel_futures=True)
+            if (self.cache is not None):
+                self.cache.commit()
+    
+    def _timed_walk(self, pics):
+        # pass the walk through, recording the time taken to find each file as the walk stage
+        it = iter(pics)
+        while True:
+            with StageTimer(None, "walk") as timer:
+                item = next(it, None)
+            if (item is None):
+                return
+            if (self.stats is not None):
+                self.stats.record("walk", timer.wall, timer.cpu)
+            yield item
+    
+    def walk_pics(self):
+        '''
+            Walk the tree under self.picroot with os.scandir, yielding (filename, stat)
+            for every file whose extension is in self.extensions. Folders rejected by
+            self.dirfilterfn are never entered, symlinked folders aren't followed, and
+            each folder's entries are visited in name order. The stat comes from the
+            DirEntry, so files aren't stat'ed again (stat is None if that failed).
+        '''
+        stack = [self.picroot]
+        while stack:
+            folder = stack.pop()
+            try:
+                with os.scandir(folder) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                print("Error listing folder '{0}' -- {1}".format(folder, e))
+                continue
+            subdirs = []
+            for entry in entries:
+                try:
+                    isdir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    isdir = False
+                if (isdir):
+                    if (self.dirfilterfn is None or self.dirfilterfn(entry.path)):
+                        subdirs.append(entry.path)
+                    continue
+                if (os.path.splitext(entry.name)[1].lower() not in self.extensions):
+                    continue
+                try:
+                    with StageTimer(self.stats, "stat"):
+                        st = entry.stat()
+                except OSError:
+                    st = None
+                yield (entry.path, st)
+            stack.extend(reversed(subdirs))
+    
+    def _make_executor(self):
+        if (self.workers is None or self.workers <= 1):
+            return None
+        if (self.pool == "process"):
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+    
+    def _start(self, pic, executor, st=None):
+        # stat (unless the walk already did) and consult the cache here; only files that
+        # need opening go to the pool
+        # returns a job of [pic, stat, result, fromcache], where result may be a Future or an exception
+        try:
+            if (st is None):
+                with StageTimer(self.stats, "stat"):
+                    st = os.stat(pic)
+            if (self.cache is not None and not self.verify):
+                cached = self.cache.lookup(pic, st)
+                if (cached is not None and (digest_algo(cached[2]) == self.algo or
+                                            (cached[2] is None and self.lazyhash))):
+                    return [pic, st, cached, True]     # unchanged since last run
+            if (executor is None):
+                return [pic, st, self._examine(pic, st), False]
+            return [pic, st, executor.submit(self._examine, pic, st), False]
+        except Exception as e:
+            return [pic, None, e, False]
+    
+    def _collect(self, job):
+        # wait for a job started by _start, return (bucket, entry), or None if it failed
+        (pic, st, result, fromcache) = job
+        self.count += 1
+        item = None
+        try:
+            if (isinstance(result, concurrent.futures.Future)):
+                result = result.result()
+            if (isinstance(result, Exception)):
+                raise result
+            (ymd, bucket, fingerprint) = result[:3]
+            if (not fromcache and self.cache is not None and (fingerprint is not None or self.lazyhash)):
+                self.cache.record(pic, st, ymd, bucket, fingerprint)
+            item = (bucket, PhotoRecord(pic, st.st_size, ymd, fingerprint))
+            if (self.sink is not None):
+                # the GPS position is only known for files examined this run, not cached ones
+                (lat, lon) = result[3:5] if (len(result) >= 5) else (None, None)
+                self.sink.add_photo(pic, bucket, st.st_size, ymd, fingerprint, lat, lon)
+        except Exception as e:
+            print("Error examining file '{0}' -- {1}".format(pic, e))
+        if (self.count % 100 == 0):
+            print("Indexing count: {0}".format(self.count))
+        return item
+    
+    def _examine(self, pic, st):
+        # the expensive part of indexing a file, run in the worker pool if there is one
+        record = self._scan_file(pic, st)
+        bucket = self._bucket_from_date(record['ymd'])  # key for dictionary (yyyy\mm)
+        return (record['ymd'], bucket, record['hash'], record['lat'], record['lon'])
+    
+    def _scan_file(self, pic, st, bufsize = 262144):
+        '''
+            Single-pass examination of a photo: the file is opened and read once,
+            every chunk goes into the hash, and the leading chunk (which holds the
+            JPEG APP1/EXIF segment) is handed to ImageData for the EXIF fields.
+            :param: pic (fully-qualified file name)
+            :param: st (os.stat result for pic, so it isn't stat'ed again)
+            :return: dict with keys size, ymd, date, origdate, digidate, lat, lon, hash
+            (hash is None with lazyhash, in which case only the leading chunk is read;
+            lat and lon are None unless there's a sink to give them to)
+        '''
+        hash = new_hasher(self.algo)
+        with StageTimer(self.stats, "hash") as hashtimer:
+            with open(pic, 'rb') as f:
+                head = f.read(bufsize)
+                hash.update(head)
+                hashtimer.nbytes = len(head)
+                with StageTimer(self.stats, "exif", len(head)) as exiftimer:
+                    image = ImageData.from_bytes(head)
+                    fields = self._exif_fields(image)
+                hashtimer.exclude(exiftimer)
+                while not self.lazyhash:
+                    data = f.read(bufsize)
+                    if not data:
+                        break
+                    hash.update(data)
+                    hashtimer.nbytes += len(data)
+        if (not image.parsed and len(head) == bufsize and PILimage is not None):
+            # EXIF wasn't parseable from the leading chunk alone (e.g. large segments
+            # ahead of it), so let PIL read the headers from the file itself
+            with StageTimer(self.stats, "exif"):
+                try:
+                    img = PILimage.open(pic)
+                except Exception:
+                    img = None      # not something PIL reads (e.g. HEIC); the file date will do
+                if (img is not None):
+                    image = ImageData(img)
+                    img.close()
+                    fields = self._exif_fields(image)
+        (earliest, date, origdate, digidate, lat, lon) = fields
+        return {'size': st.st_size,
+                'ymd': self._ymd_from(earliest, st),
+                'date': date,
+                'origdate': origdate,
+                'digidate': digidate,
+                'lat': lat,
+                'lon': lon,
+                'hash': None if self.lazyhash else tag_digest(self.algo, hash.hexdigest())}
+    
+    def _exif_fields(self, image):
+        # the ImageData fields _scan_file reports, leaving the GPS IFD unread unless it's wanted
+        if (self.wantgps):
+            (lat, lon) = (image.lat, image.lon)
+        else:
+            (lat, lon) = (None, None)
+        (date, origdate, digidate) = (image.date, image.origdate, image.digidate)
+        if (self.stats is not None):
+            for value in (date, origdate, digidate):
+                if (value is not None and parse_exif_date(value) is None):
+                    self.stats.count("malformed_date")
+        return (image.earliest_date, date, origdate, digidate, lat, lon)
+    
     @staticmethod
-    def hash_file(file, bufsize = 262144):
+    def hash_file(file, bufsize = 262144, algo = DEFAULT_HASH):
         try:
-            hash = hashlib.sha256()
+            hash = new_hasher(algo)
             with open(file, 'rb') as f:
                 while True:
                     data = f.read(bufsize)
                     if not data:
                         break
                     hash.update(data)
-            return hash.hexdigest()
+            return tag_digest(algo, hash.hexdigest())
         except:
             return None
     
     def _truncate_to_hms(self, dt):
         if not isinstance(dt, datetime.datetime):
             raise ValueError("Non-datetime passed to truncate_to_hms")
-        return datetime.datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
-    
-    def _try_strptime(self, s, format):
-        """
-        @param s the string to parse
-        @param format the format to attempt parsing of the given string
-        @return the parsed datetime or None on failure to parse 
-        @see datetime.datetime.strptime
-        """
-        try:
-            date = datetime.datetime.strptime(s, format)
-        except ValueError:
-            date = None
-        return date
+        return dt.replace(microsecond=0, tzinfo=None)
     
     def _parse_dt(self, dtstr):
         if isinstance(dtstr, datetime.datetime):
-            return _truncate_to_hms(dtstr)
+            return self._truncate_to_hms(dtstr)
         if isinstance(dtstr, str):
-            result = self._try_strptime(dtstr, "%Y-%m-%d %H:%M:%S") \
-                    or self._try_strptime(dtstr, "%Y/%m/%d %H:%M:%S") \
-                    or self._try_strptime(dtstr, "%Y:%m:%d %H:%M:%S")
-            if result and isinstance(result, datetime.datetime):
-                return self._truncate_to_hms(result)
+            return parse_exif_date(dtstr)
         return None
         
     def _bucket_from_date(self, dt):
@@ -882,91 +3267,526 @@ class PhotoIndexer(object):
             return None
         return "{0:04}\\{1:02}".format(dt.year, dt.month)
     
-    def _image_date(self, pic):
-        stat = os.stat(pic)
-        fsize = stat.st_size
-        ctime = self._truncate_to_hms(datetime.datetime.fromtimestamp(stat.st_ctime))
-        mtime = self._truncate_to_hms(datetime.datetime.fromtimestamp(stat.st_mtime))
-        filetime = ctime if ctime < mtime else mtime    # create time can be later than mod time!
-        img = PILimage.open(pic)
-        image = ImageData(img)
-        earliest_exif_date = self._parse_dt(image.earliest_date)
-        date = filetime # TEMP
-        date = earliest_exif_date or filetime   #EXIF data is considered authoritative
-        ymd = datetime.datetime(date.year, date.month, date.day)
-        img.close()
-        return ymd
+    def _ymd_from(self, exifdate, stat):
+        # date (at midnight) a photo belongs to: its EXIF date if it has one, else its file time
+        date = self._parse_dt(exifdate)     # EXIF data is considered authoritative
+        if (date is None):
+            # create time can be later than mod time!
+            date = datetime.datetime.fromtimestamp(min(stat.st_ctime, stat.st_mtime))
+        return datetime.datetime(date.year, date.month, date.day)
     
 #############################################################################################
 
+# List of path substrings that we're not interested in
+EXCLUDES = ["Backup_Photos", ":\\Program Files", "RECYCLE.BIN", ":\\ProgramData", "\\INetCache", "\\cache",
+            "\\AppData", "\\Windows", "\\CLIPART", "\\Paint Shop Pro 7", "\\WebTemplates", "\\Sample",
+            "\\Visual Studio", "\\depot", "\\Device Stage", "\\Eclipse\\features", "\\All Users\\Adobe\\Elements",
+            "\\All Users\\Adobe\\Photoshop Elements"]
+
+# file names (upper-cased) starting with any of these are skipped
+EXCLUDE_PREFIXES = ["ALBUMART"]
+
+####################   PathFilter   ####################################################
+class PathFilter(object):
+    '''
+        Reusable file filter for PhotoIndexer.set_filterfn. The folder excludes
+        (case-insensitive substrings, where \\ or / matches either separator) are
+        compiled into a single regex, and the verdict for each folder is cached,
+        so a folder of thousands of photos is only matched once. Calling the
+        filter with a file name returns True to process the file; ok_dir tells
+        PhotoIndexer.walk_pics which folders it needn't enter.
+    '''
+    def __init__(self, excludes=EXCLUDES, prefixes=EXCLUDE_PREFIXES):
+        '''
+            :param: excludes (substrings; a file whose folder contains any of them is skipped)
+            :param: prefixes (a file whose upper-cased name starts with any of them is skipped)
+        '''
+        self.excludes = list(excludes)
+        self.prefixes = tuple(p.upper() for p in prefixes)
+        alternatives = ["[\\\\/]".join(re.escape(part) for part in re.split(r"[\\/]", ex)) for ex in self.excludes]
+        self.regex = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+        self.dircache = dict()  # folder -> verdict
+    
+    @classmethod
+    def from_file(cls, filename):
+        '''
+            Build a PathFilter from a text file holding one folder exclude per line.
+            Lines starting "prefix:" give a file name prefix to skip instead; blank
+            lines and lines starting with # are ignored.
+        '''
+        excludes = []
+        prefixes = []
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if (not line or line.startswith("#")):
+                    continue
+                if (line.lower().startswith("prefix:")):
+                    prefixes.append(line[len("prefix:"):].strip())
+                else:
+                    excludes.append(line)
+        return cls(excludes, prefixes)
+    
+    def ok_dir(self, dir):
+        # True unless folder dir contains an exclude
+        verdict = self.dircache.get(dir)
+        if (verdict is None):
+            verdict = self.regex is None or self.regex.search(dir) is None
+            self.dircache[dir] = verdict
+        return verdict
+    
+    def __call__(self, f):
+        if (not self.ok_dir(os.path.dirname(f))):
+            return False
+        return not os.path.basename(f).upper().startswith(self.prefixes)
+    
+
+DEFAULT_FILTER = PathFilter()
+
+def ok_to_descend(dir):
+    '''
+        Boolean function used by PhotoIndexer.walk_pics to decide whether to enter
+        folder dir. Any file below a folder containing an exclude would fail
+        ok_to_process, so such folders are skipped whole.
+    '''
+    return DEFAULT_FILTER.ok_dir(dir)
+
 # Our basic filtering function
 def ok_to_process(f):
     '''
         Boolean function used by index_pics to determine whether to process file f
     '''
     try:
-        # return true if we want to exclude this file
-        dir = os.path.dirname(f)
-        # List of path substrings that we're not interested in
-        excludes = ["Backup_Photos", ":\\Program Files", "RECYCLE.BIN", ":\\ProgramData", "\\INetCache", "\\cache",
-                    "\\AppData", "\\Windows", "\\CLIPART", "\\Paint Shop Pro 7", "\\WebTemplates", "\\Sample",
-                    "\\Visual Studio", "\\depot", "\\Device Stage", "\\Eclipse\\features", "\\All Users\\Adobe\\Elements",
-                    "\\All Users\\Adobe\\Photoshop Elements"]
-        for ex in excludes:
-            if ex.lower() in dir.lower():
-                return False
-        # skip AlbumArt files
-        base = os.path.basename(f).upper()
-        if base.startswith("ALBUMART"):
-            return False
-        # if all pass, keep the file
-        return True
+        # folder excludes and AlbumArt files, see PathFilter
+        return DEFAULT_FILTER(f)
     except:
         print("ERROR: Filter function ok_to_process failed on passed file \"{0}\", returned False".format(f))
         return False
 
-def copy_indexed_pics_to_backup(pics, destroot):
+ok_to_process.ok_dir = ok_to_descend    # lets PhotoIndexer prune excluded folders
+
+
+####################   BackupPlan   ####################################################
+class BackupPlan(object):
+    '''
+        What a backup would do, as worked out by plan_indexed_pics without
+        touching the archive: an action for every source file (copy, rename,
+        i.e. copy under a new name, dupe, near_dupe, invalid or error), and per
+        bucket the files and bytes each action covers. estimate() turns the
+        bytes to copy into a duration, from a throughput in bytes per second
+        measured by an earlier run (see throughput_from_report) or, failing
+        that, by reading a sample of the files to be copied.
+    '''
+    ACTIONS = ("copy", "rename", "dupe", "near_dupe", "invalid", "error")
+    SAMPLE_BYTES = 64 * 1024 * 1024     # read by measure_throughput
+    def __init__(self, destroot):
+        self.DestRoot = destroot
+        self.Actions = []   # (source, bucket, action, archive name or None, size)
+        self.Buckets = dict()   # bucket -> {action: [files, bytes]}, in order first seen
+    
+    def add(self, source, bucket, action, name=None, size=0):
+        self.Actions.append((source, bucket, action, name, size))
+        totals = self.Buckets.setdefault(bucket, dict()).setdefault(action, [0, 0])
+        totals[0] += 1
+        totals[1] += size
+    
+    def totals(self, actions=("copy", "rename")):
+        # (files, bytes) over every bucket for the given actions
+        (files, nbytes) = (0, 0)
+        for counts in self.Buckets.values():
+            for action in actions:
+                (n, b) = counts.get(action, (0, 0))
+                files += n
+                nbytes += b
+        return (files, nbytes)
+    
+    def estimate(self, throughput):
+        # seconds needed to copy everything planned, at throughput bytes per second
+        if (not throughput):
+            return None
+        return self.totals()[1] / float(throughput)
+    
+    @staticmethod
+    def throughput_from_report(filename):
+        '''
+            Copy throughput, in bytes per second, measured by a run that wrote a
+            RunStats report (backup_photos report=...), or None if it copied nothing
+        '''
+        with open(filename) as f:
+            copy = json.load(f)["stages"].get("copy")
+        if (not copy or not copy["wall_seconds"]):
+            return None
+        return copy["bytes"] / copy["wall_seconds"]
+    
+    def measure_throughput(self, limit=None):
+        '''
+            Fallback when no earlier run has measured copy throughput: time
+            reading up to limit (default SAMPLE_BYTES) of the files planned to be
+            copied. Reading the sources is only part of a copy, so this is an
+            upper bound on the copy rate.
+            :return: bytes per second, or None if there's nothing to read
+        '''
+        limit = limit or self.SAMPLE_BYTES
+        nbytes = 0
+        start = time.perf_counter()
+        for (source, bucket, action, name, size) in self.Actions:
+            if (action not in ("copy", "rename")):
+                continue
+            try:
+                with open(source, 'rb') as f:
+                    while (nbytes < limit):
+                        data = f.read(COPY_BUFSIZE)
+                        if not data:
+                            break
+                        nbytes += len(data)
+            except OSError:
+                continue
+            if (nbytes >= limit):
+                break
+        elapsed = time.perf_counter() - start
+        if (nbytes == 0 or elapsed <= 0):
+            return None
+        return nbytes / elapsed
+    
+    def print_summary(self, throughput=None):
+        for (bucket, counts) in self.Buckets.items():
+            (ncopy, bcopy) = counts.get("copy", (0, 0))
+            (nrename, brename) = counts.get("rename", (0, 0))
+            if (ncopy + nrename > 0):
+                print("Would copy {0} file(s) ({1:.1f} MB) to bucket {2}, {3} renamed".format(
+                    ncopy + nrename, (bcopy + brename) / (1024.0 * 1024), bucket, nrename))
+            nskip = sum(counts.get(action, (0, 0))[0] for action in ("dupe", "near_dupe"))
+            if (nskip > 0):
+                print("Would skip {0} file(s) that already exist in bucket {1}".format(nskip, bucket))
+            nbad = sum(counts.get(action, (0, 0))[0] for action in ("invalid", "error"))
+            if (nbad > 0):
+                print("Could not plan {0} file(s) for bucket {1}".format(nbad, bucket))
+        (files, nbytes) = self.totals()
+        print("Total of {0} file(s), {1:.1f} MB, would be copied to {2}".format(
+            files, nbytes / (1024.0 * 1024), self.DestRoot))
+        seconds = self.estimate(throughput)
+        if (seconds is not None):
+            print("Estimated copy time {0} at {1:.1f} MB/s".format(
+                datetime.timedelta(seconds=int(round(seconds))), throughput / (1024.0 * 1024)))
+    
+    def write_json(self, filename, throughput=None):
+        # the whole plan: per-bucket totals and every file's action
+        (files, nbytes) = self.totals()
+        plan = {"destroot": self.DestRoot,
+                "files_to_copy": files,
+                "bytes_to_copy": nbytes,
+                "throughput": throughput,
+                "estimated_seconds": self.estimate(throughput),
+                "buckets": dict((bucket, dict((action, {"files": n, "bytes": b})
+                                              for (action, (n, b)) in counts.items()))
+                                for (bucket, counts) in self.Buckets.items()),
+                "actions": [{"source": source, "bucket": bucket, "action": action, "name": name, "size": size}
+                            for (source, bucket, action, name, size) in self.Actions]}
+        with open(filename, 'w') as f:
+            json.dump(plan, f, indent=2)
+
+def copy_indexed_pics_to_backup(pics, destroot, copyworkers = 0, maxinflight = 256 * 1024 * 1024, **archiveopts):
+    '''
+        Archive every photo in an index built by index_pics, printing a
+        copied/skipped/renamed summary per bucket.
+        :param: copyworkers (copies to run at once through an ArchiveWriter; 0 or 1 copies serially)
+        :param: maxinflight (with copyworkers, the most bytes being copied at any one time)
+        :param: archiveopts (passed on to ArchiveMgr: globaldedup, sizefirst, algo, verifycopy, ...)
+    '''
     total_copied = 0
-    am = ArchiveMgr(destroot)
+    am = ArchiveMgr(destroot, **archiveopts)
+    submitted = dict()
+    writer = None
+    if (copyworkers is not None and copyworkers > 1):
+        # queue up every copy first; the summaries below wait on them bucket by bucket
+        writer = ArchiveWriter(am, copyworkers, maxinflight)
+        for bucket in pics:
+            if (pics[bucket] is not None):
+                submitted[bucket] = [(fname, writer.submit(fname, bucket, hash, fsize))
+                                     for (fname, fsize, fdate, hash) in pics[bucket]]
     for bucket in pics:
-        nskipped = 0
         print("\nProcessing {0}".format(bucket))
         monthpics = pics[bucket]    # list of [filename, size, date, hash]
-        copiedthisbucket = 0
-        nrenamed = 0
         if (monthpics is None):
             print("No data found for monthly bucket {0}?".format(bucket))
             continue    # go to next month/bucket
-        for picdata in monthpics:
-            (fname, fsize, fdate, hash) = picdata
-            result = am.submit_file_for_backup(fname, bucket, hash)
-            if (result[1] is None):
-                nskipped += 1
+        counts = [0, 0, 0]
+        if (writer is not None):
+            for (fname, future) in submitted[bucket]:
+                _count_result(counts, fname, future.result(), am)
+        else:
+            for picdata in monthpics:
+                (fname, fsize, fdate, hash) = picdata
+                result = am.submit_file_for_backup(fname, bucket, hash, fsize)
+                _count_result(counts, fname, result, am)
+        total_copied += _print_bucket_counts(bucket, counts)
+    if (writer is not None):
+        writer.close()
+    am.close()
+    print("Total of {0} file(s) copied to backup".format(total_copied))
+    _print_copy_strategies(am)
+
+
+def plan_indexed_pics(pics, destroot, **archiveopts):
+    '''
+        Dry run of copy_indexed_pics_to_backup: dedup every photo in an index
+        built by index_pics against the archive (and against each other), and
+        name the ones that would be copied, without creating or copying anything.
+        :param: archiveopts (passed on to ArchiveMgr: globaldedup, sizefirst, algo, ...)
+        :return: BackupPlan
+    '''
+    am = ArchiveMgr(destroot, dryrun=True, **archiveopts)
+    plan = BackupPlan(destroot)
+    actions = {"DUPE_ENTRY": "dupe", "NEAR_DUPE": "near_dupe", "INVALID_BUCKET": "invalid"}
+    for bucket in pics:
+        if (pics[bucket] is None):
+            continue
+        for (fname, fsize, fdate, hash) in pics[bucket]:
+            try:
+                result = am.plan_file_for_backup(fname, bucket, hash, fsize)
+            except Exception as e:
+                print("Error planning backup of {0} -- {1}".format(fname, e))
+                result = ["ERROR", None]
+            if (result[0] == "COPY"):
+                name = os.path.basename(result[1])
+                plan.add(fname, bucket, "copy" if name == os.path.basename(fname) else "rename", name, fsize)
             else:
-                copiedthisbucket += 1
-                # was it renamed?
-                baseIn = os.path.basename(fname)
-                baseOut = os.path.basename(result[1])
-                if (baseIn != baseOut):
-                    nrenamed += 1
-        if (copiedthisbucket > 0):
-            print("Copied {0} file(s) to bucket {1}, {2} renamed".format(copiedthisbucket, bucket, nrenamed))
-            total_copied += copiedthisbucket
-        if (nskipped > 0):
-            print("Skipped {0} file(s) that already existed in bucket {1}".format(nskipped, bucket))
+                plan.add(fname, bucket, actions.get(result[0], "error"), None, fsize)
+            if (am.Stats is not None):
+                am.Stats.count("planned_" + plan.Actions[-1][2])
+    am.close()
+    return plan
+
+
+def _count_result(counts, fname, result, am=None):
+    # tally a submit_file_for_backup result into counts = [copied, skipped, renamed],
+    # and into am's journal and run stats if it has them
+    if (am is not None and am.Journal is not None and result[0] in ("SUCCESS", "DUPE_ENTRY", "NEAR_DUPE")):
+        am.Journal.pic_done(fname)      # nothing left to do for it on a rerun
+    if (am is not None and am.Stats is not None):
+        am.Stats.count(result[0].lower())
+    if (result[1] is None):
+        counts[1] += 1
+    else:
+        counts[0] += 1
+        # was it renamed?
+        if (os.path.basename(fname) != os.path.basename(result[1])):
+            counts[2] += 1
+            if (am is not None and am.Stats is not None):
+                am.Stats.count("renamed")
+
+
+def _print_bucket_counts(bucket, counts):
+    # print a bucket's summary, return the number of files copied to it
+    (copiedthisbucket, nskipped, nrenamed) = counts
+    if (copiedthisbucket > 0):
+        print("Copied {0} file(s) to bucket {1}, {2} renamed".format(copiedthisbucket, bucket, nrenamed))
+    if (nskipped > 0):
+        print("Skipped {0} file(s) that already existed in bucket {1}".format(nskipped, bucket))
+    return copiedthisbucket
+
+
+def _print_copy_strategies(am):
+    if (am.CopyStrategies):
+        print("Copy methods used: {0}".format(", ".join(
+            "{0} x{1}".format(name, n) for (name, n) in am.CopyStrategies.most_common())))
+
+
+def stream_pics_to_backup(indexer, destroot, queuesize = 1000, copyworkers = 0, maxinflight = 256 * 1024 * 1024,
+                          **archiveopts):
+    '''
+        Streaming alternative to index_pics followed by copy_indexed_pics_to_backup.
+        The indexer runs on a background thread and hands each photo over through a
+        bounded queue as soon as it has been examined, so copying overlaps scanning
+        and memory stays flat however large the source tree is. Per-bucket
+        copied/skipped/renamed summaries are printed once everything is done.
+        :param: indexer (PhotoIndexer, already configured)
+        :param: destroot (archive root)
+        :param: queuesize (maximum number of indexed photos waiting to be copied)
+        :param: copyworkers (copies to run at once through an ArchiveWriter; 0 or 1 copies serially)
+        :param: maxinflight (with copyworkers, the most bytes being copied at any one time)
+        :param: archiveopts (passed on to ArchiveMgr: globaldedup, sizefirst, verifycopy, ...;
+                algo defaults to the indexer's)
+    '''
+    q = queue.Queue(maxsize=queuesize)
+    def produce():
+        try:
+            for item in indexer.iter_pics():
+                q.put(item)
+        except Exception as e:
+            print("Error indexing {0} -- {1}".format(indexer.picroot, e))
+        finally:
+            q.put(None)     # end of stream
+    producer = threading.Thread(target=produce, name="PhotoIndexer", daemon=True)
+    producer.start()
+    archiveopts.setdefault("algo", indexer.algo)
+    am = ArchiveMgr(destroot, **archiveopts)
+    writer = None
+    if (copyworkers is not None and copyworkers > 1):
+        writer = ArchiveWriter(am, copyworkers, maxinflight)
+    tally = dict()      # bucket -> [copied, skipped, renamed], in order first seen
+    pending = collections.deque()   # (bucket, fname, future) of copies not yet tallied
+    while True:
+        item = q.get()
+        if (item is None):
+            break
+        (bucket, picdata) = item
+        (fname, fsize, fdate, hash) = picdata
+        tally.setdefault(bucket, [0, 0, 0])
+        if (writer is not None):
+            pending.append((bucket, fname, writer.submit(fname, bucket, hash, fsize)))
+            while (pending and pending[0][2].done()):
+                (b, f, future) = pending.popleft()
+                _count_result(tally[b], f, future.result(), am)
+        else:
+            result = am.submit_file_for_backup(fname, bucket, hash, fsize)
+            _count_result(tally[bucket], fname, result, am)
+    while pending:
+        (b, f, future) = pending.popleft()
+        _count_result(tally[b], f, future.result(), am)
+    producer.join()
+    if (writer is not None):
+        writer.close()
+    am.close()
+    print("Total of {0} photo(s) indexed".format(indexer.count))
+    total_copied = 0
+    for bucket in tally:
+        print("\nProcessed {0}".format(bucket))
+        total_copied += _print_bucket_counts(bucket, tally[bucket])
     print("Total of {0} file(s) copied to backup".format(total_copied))
+    _print_copy_strategies(am)
 
 
 #########################################
 #   Top-level backup function, takes a source root location, a destination
 #   root location, and a boolean file filter function. Indexes, hashes,
 #   and copies distinct photos to destination in yyyy\mm buckets (subfolders)
+#   indexcache names an optional SourceIndexCache database; verify=True
+#   re-examines every source file regardless of what the cache says.
+#   workers > 1 examines that many source files at once, in a thread
+#   pool or (pool="process") a process pool.
+#   stream=True copies photos while the tree is still being indexed.
+#   globaldedup=True skips photos already archived under any bucket.
+#   sizefirst=True only hashes photos whose size matches an archived file.
+#   algo picks the hash algorithm (see HASHERS, benchmark_hashers); by default
+#   an existing archive keeps the one it was made with, and a new one gets
+#   DEFAULT_HASH. A different algo is only used with rehash=True, which
+#   switches the archive over and rehashes it.
+#   verifycopy=True hashes each copy as it is written and checks it.
+#   copyworkers > 1 runs that many archive copies at once, with at most
+#   maxinflight bytes being copied at a time.
+#   extensions lists the file types to index (default PhotoIndexer.EXTENSIONS).
+#   columnar=True holds the index in a compact PhotoIndex (for huge trees).
+#   journal=True keeps a BackupJournal under destroot, so an interrupted run
+#   can be rerun with the same arguments to resume it (see BackupJournal).
+#   neardupes=N also looks for photos within N bits (of 64) of an archived
+#   photo's perceptual hash; nearaction="report" lists them, "skip" doesn't
+#   archive them either. Needs PIL.
+#   sink (a CatalogSink) gets a row for every photo indexed and file archived.
+#   report names a JSON file to write per-stage timings and counts to, and
+#   promfile a Prometheus textfile (see RunStats).
+#   naming="numeric" names colliding files IMG_0001_1.JPG, IMG_0001_2.JPG, ...
+#   rather than with tildes; an existing archive keeps the scheme it was made with.
+#   prewarm > 0 first hashes any archived files the catalog doesn't know,
+#   that many at a time (see warm_archive).
+#   dryrun=True only indexes and plans the backup (see BackupPlan): nothing
+#   under destroot is created or changed. The plan is printed per bucket, and
+#   with planfile written out as JSON with every file's action. The copy time
+#   is estimated at throughput bytes/s, or the copy rate in an earlier run's
+#   report if throughput names one, or else the rate the sources read at.
+#   Returns the BackupPlan.
 #########################################
-def backup_photos(fromroot, destroot, filterfn = ok_to_process):
-    indexer = PhotoIndexer(fromroot)
+def backup_photos(fromroot, destroot, filterfn = ok_to_process, indexcache = None, verify = False,
+                  workers = 0, pool = "thread", stream = False, globaldedup = False, sizefirst = False,
+                  algo = None, verifycopy = False, copyworkers = 0, maxinflight = 256 * 1024 * 1024,
+                  naming = None, prewarm = 0, extensions = None, columnar = False, journal = False,
+                  report = None, promfile = None, neardupes = None, nearaction = "report", sink = None,
+                  dryrun = False, planfile = None, throughput = None, rehash = False):
+    stats = RunStats() if (report or promfile) else None
+    algo = archive_algo(ArchiveCatalog.stored_meta(destroot, "algo"), algo, rehash)
+    if (dryrun):
+        plan = _plan_photos(fromroot, destroot, filterfn, indexcache, verify, workers, pool, sizefirst, algo,
+                            extensions, columnar, stats, planfile, throughput,
+                            dict(globaldedup=globaldedup, sizefirst=sizefirst, algo=algo, naming=naming,
+                                 stats=stats, neardupes=neardupes, nearaction=nearaction, rehash=rehash))
+        if (report):
+            stats.write_json(report)
+        if (promfile):
+            stats.write_prometheus(promfile)
+        return plan
+    if (prewarm):
+        warm_archive(destroot, workers=prewarm, algo=algo, rehash=rehash)
+    if (journal):
+        journal = BackupJournal(destroot)
+        if (indexcache is None):
+            indexcache = journal.CacheFile  # checkpoints indexing progress
+    else:
+        journal = None
+    indexer = PhotoIndexer(fromroot, cache=indexcache, verify=verify, workers=workers, pool=pool,
+                           lazyhash=sizefirst, algo=algo, extensions=extensions, stats=stats, sink=sink)
     indexer.set_filterfn(filterfn)
-    idx = indexer.index_pics()
-    copy_indexed_pics_to_backup(idx, destroot)
+    archiveopts = dict(globaldedup=globaldedup, sizefirst=sizefirst, algo=algo, verifycopy=verifycopy,
+                       naming=naming, journal=journal, stats=stats, neardupes=neardupes,
+                       nearaction=nearaction, sink=sink, rehash=rehash)
+    if (stream):
+        stream_pics_to_backup(indexer, destroot, copyworkers=copyworkers, maxinflight=maxinflight, **archiveopts)
+    else:
+        if (journal is not None and journal.indexed()):
+            idx = journal.load_index(columnar, algo)
+            print("Resuming interrupted backup: {0} photo(s) left to archive".format(
+                sum(len(idx[bucket]) for bucket in idx)))
+        else:
+            idx = indexer.index_pics(columnar=columnar)
+            if (journal is not None):
+                journal.save_index(idx)
+        copy_indexed_pics_to_backup(idx, destroot, copyworkers=copyworkers, maxinflight=maxinflight, **archiveopts)
+    if (indexer.cache is not None):
+        indexer.cache.close()
+    if (journal is not None):
+        journal.finish()
+    if (sink is not None):
+        sink.flush()
+    if (report):
+        stats.write_json(report)
+    if (promfile):
+        stats.write_prometheus(promfile)
+
+
+def _plan_photos(fromroot, destroot, filterfn, indexcache, verify, workers, pool, sizefirst, algo,
+                 extensions, columnar, stats, planfile, throughput, archiveopts):
+    # backup_photos(dryrun=True): index, plan, and report the plan
+    indexer = PhotoIndexer(fromroot, cache=indexcache, verify=verify, workers=workers, pool=pool,
+                           lazyhash=sizefirst, algo=algo, extensions=extensions, stats=stats)
+    indexer.set_filterfn(filterfn)
+    idx = indexer.index_pics(columnar=columnar)
+    if (indexer.cache is not None):
+        indexer.cache.close()
+    plan = plan_indexed_pics(idx, destroot, **archiveopts)
+    if (isinstance(throughput, str)):
+        throughput = BackupPlan.throughput_from_report(throughput)
+    if (not throughput):
+        throughput = plan.measure_throughput()
+    plan.print_summary(throughput)
+    if (planfile):
+        plan.write_json(planfile, throughput)
+    return plan
+
+
+#########################################
+#   Pre-warm an archive: hash every archived file its catalog doesn't know
+#   yet, workers at a time, so later backups only stat the archive. Can be
+#   scheduled off-peak, or run by backup_photos (prewarm=N) before copying.
+#########################################
+def warm_archive(destroot, workers = 4, algo = None, rehash = False):
+    am = ArchiveMgr(destroot, algo=algo, rehash=rehash)
+    start = time.time()
+    nhashed = am.warm(workers)
+    am.close()
+    print("Warmed archive {0}: hashed {1} file(s) in {2:.1f}s".format(destroot, nhashed, time.time() - start))
+    return nhashed
 
 # example invocation:
 # backup_photos(fromroot="C:\\", destroot="J:\\Backup_Photos", filterfn=ok_to_process)
+# warm_archive(destroot="J:\\Backup_Photos", workers=8)
+# backup_photos(fromroot="C:\\", destroot="J:\\Backup_Photos", filterfn=PathFilter.from_file("excludes.txt"))
+# backup_photos(fromroot="C:\\", destroot="J:\\Backup_Photos", dryrun=True, planfile="plan.json", throughput="last_run.json")
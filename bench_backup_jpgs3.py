@@ -0,0 +1,314 @@
+'''
+    Benchmark harness for backup_jpgs3.
+
+    Builds a reproducible synthetic photo tree (JPEG files carrying real EXIF
+    blocks, with configurable file count, size distribution, duplicate ratio,
+    date spread and name collisions), then times index_pics, ImageData
+    extraction, _hydrate_bucket, _gen_safe_filename and a full backup_photos
+    run. Results can be saved as JSON and compared against a saved baseline:
+
+        python bench_backup_jpgs3.py --files 2000 --save baseline.json
+        python bench_backup_jpgs3.py --files 2000 --baseline baseline.json
+'''
+try:
+    import sys
+    import os
+    import io
+    import json
+    import time
+    import random
+    import shutil
+    import struct
+    import argparse
+    import datetime
+    import tempfile
+    import contextlib
+    import backup_jpgs3
+except ImportError as err:
+    exit(err)
+
+
+####################   Synthetic photos   ##############################
+def _ifd(entries, start, nextifd=0):
+    '''
+        Serialize a little-endian TIFF IFD placed at offset start
+        :param: entries (list of (tag, type, count, value bytes))
+        :return: bytes of the IFD followed by the values too big for its entries
+    '''
+    entries = sorted(entries)
+    datastart = start + 2 + 12 * len(entries) + 4
+    head = struct.pack('<H', len(entries))
+    body = b''
+    for (tag, type, count, data) in entries:
+        if (len(data) <= 4):
+            head += struct.pack('<HHI', tag, type, count) + data.ljust(4, b'\x00')
+        else:
+            head += struct.pack('<HHII', tag, type, count, datastart + len(body))
+            body += data
+            if (len(body) % 2):
+                body += b'\x00'
+    return head + struct.pack('<I', nextifd) + body
+
+
+def _ascii(s):
+    data = s.encode('ascii') + b'\x00'
+    return (2, len(data), data)
+
+
+def _rationals(values):
+    return (5, len(values), b''.join(struct.pack('<II', num, den) for (num, den) in values))
+
+
+def make_exif(date, gps=None):
+    '''
+        Build the TIFF block of an EXIF segment with DateTime, DateTimeOriginal,
+        DateTimeDigitized and, if gps is a (lat, lon) pair, a GPS IFD
+    '''
+    stamp = date.strftime("%Y:%m:%d %H:%M:%S")
+    exifentries = [(0x9003,) + _ascii(stamp), (0x9004,) + _ascii(stamp)]
+    gpsentries = None
+    if (gps is not None):
+        def dms(value):
+            value = abs(value)
+            d = int(value)
+            m = int((value - d) * 60)
+            s = int(round(((value - d) * 60 - m) * 60 * 100))
+            return [(d, 1), (m, 1), (s, 100)]
+        (lat, lon) = gps
+        gpsentries = [(1,) + _ascii('N' if lat >= 0 else 'S'), (2,) + _rationals(dms(lat)),
+                      (3,) + _ascii('E' if lon >= 0 else 'W'), (4,) + _rationals(dms(lon))]
+    def ifd0(exifoffset, gpsoffset):
+        entries = [(0x0132,) + _ascii(stamp), (0x8769, 4, 1, struct.pack('<I', exifoffset))]
+        if (gpsentries is not None):
+            entries.append((0x8825, 4, 1, struct.pack('<I', gpsoffset)))
+        return _ifd(entries, 8)
+    # IFD0's size doesn't depend on the offsets in it, so lay it out once to find them
+    exifoffset = 8 + len(ifd0(0, 0))
+    exififd = _ifd(exifentries, exifoffset)
+    gpsoffset = exifoffset + len(exififd)
+    tiff = b'II*\x00' + struct.pack('<I', 8) + ifd0(exifoffset, gpsoffset) + exififd
+    if (gpsentries is not None):
+        tiff += _ifd(gpsentries, gpsoffset)
+    return tiff
+
+
+def make_jpeg(size, rng, date=None, gps=None):
+    '''
+        Bytes of a synthetic JPEG of roughly size bytes: SOI, an APP1 EXIF
+        segment (left out if date is None), then random "scan data" and EOI.
+        It isn't a decodable image, but it is laid out like one as far as the
+        EXIF readers are concerned.
+    '''
+    data = b'\xff\xd8'
+    if (date is not None):
+        app1 = b'Exif\x00\x00' + make_exif(date, gps)
+        data += b'\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1
+    data += b'\xff\xda\x00\x08' + bytes(6)
+    data += rng.randbytes(max(0, size - len(data) - 2))
+    return data + b'\xff\xd9'
+
+
+def make_tree(root, files=1000, median=128 * 1024, sigma=0.8, dupes=0.1, spread=730,
+              collisions=0.2, noexif=0.05, gps=0.3, perdir=100, seed=1):
+    '''
+        Write a synthetic photo tree under root
+        :param: files (number of files)
+        :param: median, sigma (file sizes are lognormal around median bytes)
+        :param: dupes (fraction of files that are byte-for-byte copies of an earlier one)
+        :param: spread (photos are dated over this many days)
+        :param: collisions (fraction of files named after an earlier file in another folder)
+        :param: noexif (fraction of files without an EXIF segment)
+        :param: gps (fraction of files with GPS tags)
+        :param: perdir (files per folder)
+        :param: seed (random seed; the same arguments always build the same tree)
+        :return: dict of what was built
+    '''
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    made = []       # (name, data, folder) of each distinct photo
+    nfiles = nbytes = ndupes = ncollisions = 0
+    for i in range(files):
+        folder = os.path.join(root, "d{0:03}".format(i // perdir), "sub{0}".format(i % 3))
+        os.makedirs(folder, exist_ok=True)
+        name = "IMG_{0:05}.JPG".format(i)
+        if (made and rng.random() < collisions):
+            (other, odata, ofolder) = rng.choice(made)
+            # only a clash if it's in another folder and doesn't overwrite what's already here
+            if (ofolder != folder and not os.path.exists(os.path.join(folder, other))):
+                name = other
+                ncollisions += 1
+        if (made and rng.random() < dupes):
+            data = rng.choice(made)[1]
+            ndupes += 1
+        else:
+            size = max(1024, int(rng.lognormvariate(0, sigma) * median))
+            date = None
+            if (rng.random() >= noexif):
+                date = start + datetime.timedelta(days=rng.randrange(max(1, spread)), seconds=rng.randrange(86400))
+            where = None
+            if (rng.random() < gps):
+                where = (rng.uniform(-80, 80), rng.uniform(-179, 179))
+            data = make_jpeg(size, rng, date, where)
+            made.append((name, data, folder))
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+        nfiles += 1
+        nbytes += len(data)
+    return {"files": nfiles, "bytes": nbytes, "dupes": ndupes, "collisions": ncollisions}
+
+
+####################   Benchmarks   ##############################
+def _best(fn, repeat):
+    # best wall time of repeat runs of fn(), and fn's last result
+    best = None
+    result = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+def bench_index(src, repeat, workers):
+    def run():
+        return backup_jpgs3.PhotoIndexer(src, workers=workers).index_pics()
+    (seconds, idx) = _best(run, repeat)
+    return {"seconds": seconds, "items": sum(len(idx[bucket]) for bucket in idx)}
+
+
+def bench_imagedata(src, repeat):
+    heads = []
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                heads.append(f.read(262144))
+    def run():
+        for head in heads:
+            backup_jpgs3.ImageData.from_bytes(head).earliest_date
+    (seconds, result) = _best(run, repeat)
+    return {"seconds": seconds, "items": len(heads)}
+
+
+def bench_hydrate(archive, repeat):
+    buckets = backup_jpgs3.ArchiveMgr(archive, catalog=False).list_buckets()
+    def run():
+        am = backup_jpgs3.ArchiveMgr(archive, catalog=False)
+        for bucket in buckets:
+            am._hydrate_bucket(bucket, am._uncached_files(bucket))
+        return am
+    (seconds, am) = _best(run, repeat)
+    return {"seconds": seconds, "items": sum(len(am.HashDict[bucket]) for bucket in am.HashDict)}
+
+
+def bench_safe_filename(workdir, repeat, names):
+    # names all fighting over a handful of stems in one bucket
+    def run():
+        am = backup_jpgs3.ArchiveMgr(workdir, catalog=False)
+        for i in range(names):
+            am._gen_safe_filename("IMG_{0:04}.JPG".format(i % 10), "2020\\01")
+    (seconds, result) = _best(run, repeat)
+    return {"seconds": seconds, "items": names}
+
+
+def bench_backup(src, workdir, repeat, workers, copyworkers):
+    dest = os.path.join(workdir, "backup")
+    def run():
+        shutil.rmtree(dest, ignore_errors=True)
+        backup_jpgs3.backup_photos(src, dest, filterfn=None, workers=workers, copyworkers=copyworkers)
+        return dest
+    (seconds, result) = _best(run, repeat)
+    return {"seconds": seconds}
+
+
+def run_benchmarks(args):
+    workdir = tempfile.mkdtemp(prefix="bench_backup_jpgs3_", dir=args.workdir)
+    try:
+        src = os.path.join(workdir, "src")
+        start = time.perf_counter()
+        tree = make_tree(src, files=args.files, median=args.median, sigma=args.sigma, dupes=args.dupes,
+                         spread=args.spread, collisions=args.collisions, noexif=args.noexif,
+                         gps=args.gps, seed=args.seed)
+        print("Built {0} file(s), {1:.1f} MB ({2} dupes, {3} name collisions) in {4:.1f}s".format(
+            tree["files"], tree["bytes"] / (1024 * 1024), tree["dupes"], tree["collisions"],
+            time.perf_counter() - start))
+        results = dict()
+        results["index_pics"] = bench_index(src, args.repeat, args.workers)
+        results["imagedata"] = bench_imagedata(src, args.repeat)
+        results["backup_photos"] = bench_backup(src, workdir, args.repeat, args.workers, args.copyworkers)
+        results["hydrate_bucket"] = bench_hydrate(os.path.join(workdir, "backup"), args.repeat)
+        results["gen_safe_filename"] = bench_safe_filename(os.path.join(workdir, "names"), args.repeat, args.names)
+        for (name, result) in results.items():
+            if (result.get("items")):
+                result["us_per_item"] = result["seconds"] * 1e6 / result["items"]
+            if (name == "backup_photos"):
+                result["mb_per_second"] = tree["bytes"] / (1024 * 1024) / result["seconds"]
+        config = dict(vars(args))
+        for key in ("save", "baseline", "workdir", "threshold"):
+            config.pop(key, None)
+        return {"config": config, "tree": tree, "results": results}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(current, baseline, threshold):
+    '''
+        Print each benchmark's time against the baseline's
+        :return: names of benchmarks more than threshold (a fraction) slower
+    '''
+    if (baseline.get("config") != current["config"]):
+        print("Warning: baseline was run with different settings: {0}".format(baseline.get("config")))
+    regressions = []
+    print("{0:<20} {1:>12} {2:>12} {3:>8}".format("benchmark", "baseline s", "current s", "ratio"))
+    for (name, result) in current["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if (old is None):
+            print("{0:<20} {1:>12} {2:>12.4f}".format(name, "-", result["seconds"]))
+            continue
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else float('inf')
+        flag = ""
+        if (ratio > 1 + threshold):
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print("{0:<20} {1:>12.4f} {2:>12.4f} {3:>8.2f}{4}".format(name, old["seconds"], result["seconds"], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark backup_jpgs3 on a synthetic photo tree")
+    parser.add_argument("--files", type=int, default=1000, help="number of photos to generate")
+    parser.add_argument("--median", type=int, default=128 * 1024, help="median photo size in bytes")
+    parser.add_argument("--sigma", type=float, default=0.8, help="spread of the lognormal size distribution")
+    parser.add_argument("--dupes", type=float, default=0.1, help="fraction of photos that are duplicates")
+    parser.add_argument("--spread", type=int, default=730, help="days the photo dates are spread over")
+    parser.add_argument("--collisions", type=float, default=0.2, help="fraction of photos reusing another's name")
+    parser.add_argument("--noexif", type=float, default=0.05, help="fraction of photos without EXIF")
+    parser.add_argument("--gps", type=float, default=0.3, help="fraction of photos with GPS tags")
+    parser.add_argument("--names", type=int, default=20000, help="names to generate for the _gen_safe_filename run")
+    parser.add_argument("--workers", type=int, default=0, help="PhotoIndexer workers")
+    parser.add_argument("--copyworkers", type=int, default=0, help="ArchiveWriter copy workers")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark; the best is kept")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic tree")
+    parser.add_argument("--workdir", default=None, help="where to build the tree (default: system temp folder)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as a regression (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+    current = run_benchmarks(args)
+    for (name, result) in current["results"].items():
+        print("{0:<20} {1:>10.4f}s  {2}".format(name, result["seconds"],
+              ", ".join("{0}={1:.2f}".format(k, v) for (k, v) in result.items() if k not in ("seconds", "items"))))
+    if (args.save):
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2)
+    if (args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (compare(current, baseline, args.threshold)):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+'''
+    Regression tests for backup_jpgs3: run with python -m unittest (or pytest)
+'''
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import backup_jpgs3
+
+
+def make_exif_jpeg(pointer=None, datetime="2017:03:04 05:06:07"):
+    '''
+        Bytes of a minimal little-endian EXIF JPEG whose IFD0 holds DateTime and
+        an ExifIFD pointer entry of (type, count, 4 inline value bytes), if given
+    '''
+    entries = [(0x0132, 2, 20, None)]   # DateTime, stored after the IFD
+    if (pointer is not None):
+        entries.append((0x8769,) + pointer)
+    dataoff = 8 + 2 + 12 * len(entries) + 4
+    ifd = struct.pack('<H', len(entries))
+    for (tag, type, count, value) in entries:
+        if (value is None):
+            value = struct.pack('<I', dataoff)
+        ifd += struct.pack('<HHI', tag, type, count) + value
+    tiff = b'II*\x00' + struct.pack('<I', 8) + ifd + struct.pack('<I', 0) + datetime.encode() + b'\x00'
+    app1 = b'Exif\x00\x00' + tiff
+    return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + b'\xff\xda\x00\x02\xff\xd9'
+
+
+# ExifIFD pointers that aren't a single offset inside the EXIF block
+BAD_POINTERS = {"ascii": (2, 4, b'abc\x00'),
+                "short_pair": (3, 2, struct.pack('<HH', 8, 8)),
+                "out_of_range": (4, 1, struct.pack('<I', 100000))}
+
+
+class TestMalformedExifPointers(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_parser_raises_exif_format_error(self):
+        for (name, pointer) in BAD_POINTERS.items():
+            with self.subTest(name):
+                block = backup_jpgs3.ExifParser.open(make_exif_jpeg(pointer))
+                with self.assertRaises(backup_jpgs3.ExifFormatError):
+                    backup_jpgs3.ExifParser.read_group(block, "exif")
+                with self.assertRaises(backup_jpgs3.ExifFormatError):
+                    backup_jpgs3.ExifParser.parse(make_exif_jpeg(pointer))
+
+    def test_valid_pointer_type_still_read(self):
+        # a LONG pointer to an (empty) IFD is fine
+        data = make_exif_jpeg((4, 1, struct.pack('<I', 8)))
+        self.assertEqual(backup_jpgs3.ExifParser.parse(data), {'DateTime': "2017:03:04 05:06:07"})
+
+    def test_malformed_pointer_still_indexed(self):
+        for (name, pointer) in BAD_POINTERS.items():
+            with open(os.path.join(self.root, name + ".jpg"), 'wb') as f:
+                f.write(make_exif_jpeg(pointer))
+        indexer = backup_jpgs3.PhotoIndexer(self.root)
+        indexer.set_filterfn(lambda f: True, lambda d: True)
+        pics = indexer.index_pics()
+        names = sorted(os.path.basename(fname) for bucket in pics for (fname, size, ymd, hash) in pics[bucket])
+        self.assertEqual(names, sorted(name + ".jpg" for name in BAD_POINTERS))
+        self.assertEqual(list(pics), ["2017\\03"])   # IFD0's DateTime still dates them
+
+
+class TestLazyImageData(unittest.TestCase):
+    def test_lazy_fields_on_malformed_pointer(self):
+        # the Exif IFD is only read when origdate (or earliest_date) is first asked for
+        for (name, pointer) in BAD_POINTERS.items():
+            with self.subTest(name):
+                image = backup_jpgs3.ImageData.from_bytes(make_exif_jpeg(pointer))
+                self.assertIsNone(image.origdate)
+                self.assertIsNone(image.digidate)
+                self.assertEqual(image.date, "2017:03:04 05:06:07")
+                self.assertEqual(image.earliest_date, "2017:03:04 05:06:07")
+
+    def test_lazy_group_failure_leaves_fields_unknown(self):
+        # whatever read_group raises, a lazily read field is just None
+        image = backup_jpgs3.ImageData.from_bytes(make_exif_jpeg((4, 1, struct.pack('<I', 8))))
+        def broken(block, group):
+            raise TypeError("simulated decoder failure")
+        original = backup_jpgs3.ExifParser.read_group
+        backup_jpgs3.ExifParser.read_group = staticmethod(broken)
+        try:
+            self.assertIsNone(image.lat)
+            self.assertIsNone(image.earliest_date)
+        finally:
+            backup_jpgs3.ExifParser.read_group = original
+
+
+class TestArchiveAlgo(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, "2017", "03"))
+        with open(os.path.join(self.root, "2017", "03", "a.jpg"), 'wb') as f:
+            f.write(make_exif_jpeg())
+        am = backup_jpgs3.ArchiveMgr(self.root)
+        self.assertEqual(am.warm(1), 1)
+        self.hashes = self.archived_hashes(am)
+        am.close()
+
+    def archived_hashes(self, am):
+        am.hydrate_all()
+        return sorted(hash for bucket in am.HashDict for hash in am.HashDict[bucket])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_other_algo_keeps_stored_digests(self):
+        am = backup_jpgs3.ArchiveMgr(self.root, algo='blake2b')
+        try:
+            self.assertEqual(am.Algo, 'sha256')
+            self.assertEqual(am.warm(1), 0)    # nothing rehashed
+            self.assertEqual(self.archived_hashes(am), self.hashes)
+        finally:
+            am.close()
+        self.assertEqual(backup_jpgs3.ArchiveCatalog.stored_meta(self.root, "algo"), 'sha256')
+
+    def test_rehash_switches_algo(self):
+        am = backup_jpgs3.ArchiveMgr(self.root, algo='blake2b', rehash=True)
+        try:
+            self.assertEqual(am.Algo, 'blake2b')
+            self.assertEqual(am.warm(1), 1)
+            hashes = self.archived_hashes(am)
+            self.assertEqual([backup_jpgs3.digest_algo(h) for h in hashes], ['blake2b'])
+        finally:
+            am.close()
+        self.assertEqual(backup_jpgs3.ArchiveCatalog.stored_meta(self.root, "algo"), 'blake2b')
+
+
+if __name__ == '__main__':
+    unittest.main()